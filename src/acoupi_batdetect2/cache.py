@@ -0,0 +1,162 @@
+"""Persistent compilation cache of the BatDetect2 Program.
+
+The `librosa` library and the `FastSpectrogram` pipeline compile numba
+functions the first time they are imported or called. Without a
+persistent cache, every new worker process, for instance after a power
+cycle or when Celery recycles a worker, compiles them again. This takes
+several seconds on a Raspberry Pi before the first recording can be
+processed.
+
+The `CompileCache` keeps the compiled functions in a directory under the
+program paths. The cache is stored in a subdirectory named after a key
+derived from the versions of the compiling libraries and the contents of
+the model checkpoint, so an upgrade starts from a fresh cache and the
+stale entries are removed.
+"""
+
+import hashlib
+import logging
+import os
+import platform
+import shutil
+import sys
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, Optional
+
+__all__ = [
+    "CompileCache",
+]
+
+logger = logging.getLogger(__name__)
+
+# Libraries whose versions invalidate the cache.
+CACHE_LIBRARIES = (
+    "numba",
+    "numpy",
+    "torch",
+    "librosa",
+    "batdetect2",
+    "acoupi_batdetect2",
+)
+
+# Size of the chunks read when hashing the model checkpoint.
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def _get_version(package: str) -> Optional[str]:
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _get_default_model_path() -> Path:
+    from batdetect2.detector import parameters
+
+    return Path(parameters.DEFAULT_MODEL_PATH)
+
+
+class CompileCache:
+    """On-disk cache of the compiled functions used by the program.
+
+    Attributes
+    ----------
+    directory : Path
+        The directory holding the cache of every library version.
+    model_path : Path
+        The model checkpoint. Its contents are part of the cache key.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        model_path: Optional[Path] = None,
+    ):
+        """Initialise the compilation cache."""
+        if model_path is None:
+            model_path = _get_default_model_path()
+
+        self.directory = directory
+        self.model_path = model_path
+        self._key: Optional[str] = None
+
+    def get_versions(self) -> Dict[str, Optional[str]]:
+        """Get the versions that the cached artefacts depend on."""
+        versions = {
+            package: _get_version(package) for package in CACHE_LIBRARIES
+        }
+        versions["python"] = sys.version
+        versions["machine"] = platform.machine()
+        versions["model"] = self._hash_model()
+        return versions
+
+    def _hash_model(self) -> Optional[str]:
+        if not self.model_path.exists():
+            return None
+
+        digest = hashlib.sha256()
+        with open(self.model_path, "rb") as model_file:
+            while chunk := model_file.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @property
+    def key(self) -> str:
+        """Name of the cache directory of the current versions."""
+        if self._key is None:
+            versions = sorted(self.get_versions().items())
+            digest = hashlib.sha256(repr(versions).encode())
+            self._key = digest.hexdigest()[:16]
+        return self._key
+
+    @property
+    def path(self) -> Path:
+        """Directory of the cache of the current versions."""
+        return self.directory / self.key
+
+    @property
+    def numba_dir(self) -> Path:
+        """Directory where numba stores the compiled functions."""
+        return self.path / "numba"
+
+    def activate(self) -> Path:
+        """Use the cache for the functions compiled by this process.
+
+        Removes the caches of previous versions. Must be called before
+        `librosa` and the `FastSpectrogram` pipeline are imported, which
+        is the case while the program is set up.
+
+        Returns
+        -------
+        Path
+            The directory of the cache of the current versions.
+        """
+        self.numba_dir.mkdir(parents=True, exist_ok=True)
+        self.clear_stale()
+
+        # Read by numba when it is first imported.
+        os.environ["NUMBA_CACHE_DIR"] = str(self.numba_dir)
+
+        if "numba" in sys.modules:
+            from numba.core import config
+
+            if config.CACHE_DIR != str(self.numba_dir):
+                logger.warning(
+                    "numba was imported before the compilation cache was "
+                    "activated, functions decorated until now are cached "
+                    "in %s",
+                    config.CACHE_DIR or "the default location",
+                )
+            config.CACHE_DIR = str(self.numba_dir)
+
+        return self.path
+
+    def clear_stale(self) -> None:
+        """Remove the caches of previous library or model versions."""
+        for path in self.directory.iterdir():
+            if path.name == self.key or not path.is_dir():
+                continue
+
+            logger.info("Removing stale compilation cache %s", path)
+            shutil.rmtree(path, ignore_errors=True)
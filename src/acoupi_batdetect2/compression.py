@@ -0,0 +1,265 @@
+"""Lossless compression of the recordings saved by the BatDetect2 Program.
+
+The `SaveRecordingManager` keeps recordings as raw WAV files. At the
+sample rates used for bat monitoring these fill the storage quickly. The
+`compression_task` transcodes the saved WAV files to FLAC in the
+background, on its own low priority worker.
+
+The progress is tracked on the file system, so that a restart resumes the
+pending work: every WAV file left in the saving directories is pending.
+Each file is encoded to a hidden partial file, which is only renamed to
+its final `.flac` name once it has been verified to decode to exactly the
+same samples as the WAV file. The WAV file is removed last, after the
+metadata store has been updated to point to the FLAC file.
+
+WAV files that can not be stored losslessly as FLAC, such as floating point
+recordings, are left untouched. A file that fails to be compressed, for
+instance because it is truncated, is marked with a hidden `.failed` file
+next to it and is not retried. Remove the marker to retry it.
+"""
+
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+import soundfile as sf
+from acoupi.components import types
+
+__all__ = [
+    "FlacEncoder",
+    "find_pending_recordings",
+    "get_failed_marker",
+    "generate_compression_task",
+]
+
+logger = logging.getLogger(__name__)
+
+# FLAC subtypes used for each WAV subtype. Floating point WAV files can
+# not be stored losslessly as FLAC and are left untouched.
+FLAC_SUBTYPES = {
+    "PCM_S8": "PCM_S8",
+    "PCM_U8": "PCM_S8",
+    "PCM_16": "PCM_16",
+    "PCM_24": "PCM_24",
+}
+
+BLOCK_FRAMES = 65536
+
+
+def get_failed_marker(path: Path) -> Path:
+    """Path of the marker of a WAV file that could not be compressed."""
+    return path.with_name(f".{path.name}.failed")
+
+
+def _is_encodable(path: Path) -> bool:
+    try:
+        subtype = sf.info(str(path)).subtype
+    except sf.LibsndfileError:
+        # Unreadable files are attempted, so that they get marked.
+        return True
+    return subtype in FLAC_SUBTYPES
+
+
+class FlacEncoder:
+    """Encode WAV files to FLAC and verify the result.
+
+    Attributes
+    ----------
+    block_frames : int
+        Number of frames read and written at once, to bound memory use.
+    """
+
+    def __init__(self, block_frames: int = BLOCK_FRAMES):
+        """Initialise the FLAC encoder."""
+        self.block_frames = block_frames
+
+    def encode(self, path: Path) -> Path:
+        """Encode a WAV file to a FLAC file next to it.
+
+        The WAV file is not removed. If a verified FLAC file already exists,
+        for instance after an interrupted run, it is reused.
+
+        Parameters
+        ----------
+        path : Path
+            Path of the WAV file.
+
+        Returns
+        -------
+        Path
+            Path of the FLAC file.
+
+        Raises
+        ------
+        ValueError
+            If the WAV format can not be stored losslessly as FLAC, or if
+            the encoded file does not match the WAV file.
+        """
+        flac_path = path.with_suffix(".flac")
+        if flac_path.exists() and self.verify(path, flac_path):
+            return flac_path
+
+        info = sf.info(str(path))
+        subtype = FLAC_SUBTYPES.get(info.subtype)
+        if subtype is None:
+            raise ValueError(
+                f"Cannot losslessly encode {info.subtype} audio as FLAC."
+            )
+
+        partial_path = path.with_name(f".{flac_path.name}.partial")
+        with sf.SoundFile(str(path)) as source:
+            with sf.SoundFile(
+                str(partial_path),
+                mode="w",
+                samplerate=source.samplerate,
+                channels=source.channels,
+                subtype=subtype,
+                format="FLAC",
+            ) as target:
+                for block in source.blocks(
+                    self.block_frames,
+                    dtype="int32",
+                ):
+                    target.write(block)
+
+        if not self.verify(path, partial_path):
+            partial_path.unlink()
+            raise ValueError(f"FLAC file does not match {path}.")
+
+        os.replace(partial_path, flac_path)
+        return flac_path
+
+    def verify(self, path: Path, flac_path: Path) -> bool:
+        """Check that both files contain exactly the same audio."""
+        try:
+            with sf.SoundFile(str(path)) as source:
+                with sf.SoundFile(str(flac_path)) as target:
+                    return self._same_audio(source, target)
+        except sf.LibsndfileError:
+            return False
+
+    def _same_audio(self, source: sf.SoundFile, target: sf.SoundFile) -> bool:
+        if (
+            source.samplerate != target.samplerate
+            or source.channels != target.channels
+            or source.frames != target.frames
+        ):
+            return False
+
+        for expected in source.blocks(self.block_frames, dtype="int32"):
+            actual = target.read(len(expected), dtype="int32")
+            if not np.array_equal(expected, actual):
+                return False
+
+        return True
+
+
+def find_pending_recordings(
+    directories: List[Path],
+    min_age: float = 0,
+) -> List[Path]:
+    """Find the WAV files waiting to be compressed, oldest first.
+
+    Files that can not be stored losslessly as FLAC and files marked as
+    failed are skipped.
+
+    Parameters
+    ----------
+    directories : List[Path]
+        The directories where recordings are saved.
+    min_age : float
+        Files moved into the directories less than `min_age` seconds ago
+        are skipped, so that the file management task can first register
+        their new path in the store.
+    """
+    now = time.time()
+    pending = []
+    for directory in directories:
+        if not directory.is_dir():
+            continue
+
+        for path in directory.glob("*.wav"):
+            try:
+                changed = path.stat().st_ctime
+            except FileNotFoundError:
+                continue
+
+            if now - changed < min_age:
+                continue
+
+            if get_failed_marker(path).exists() or not _is_encodable(path):
+                continue
+
+            pending.append(path)
+
+    return sorted(pending, key=lambda path: path.name)
+
+
+def generate_compression_task(
+    directories: List[Path],
+    store: types.Store,
+    encoder: FlacEncoder,
+    max_files: int = 20,
+    min_age: float = 60,
+    niceness: int = 10,
+    logger: logging.Logger = logger,
+) -> Callable[[], None]:
+    """Generate a task that compresses the saved recordings to FLAC.
+
+    Parameters
+    ----------
+    directories : List[Path]
+        The directories where recordings are saved.
+    store : types.Store
+        The metadata store, to update the path of the recordings.
+    encoder : FlacEncoder
+        The FLAC encoder.
+    max_files : int
+        Maximum number of recordings compressed per run.
+    min_age : float
+        Minimum time (in seconds) since a recording was saved.
+    niceness : int
+        Niceness added to the worker process, on its first run.
+    logger : logging.Logger, optional
+        The logger to log messages, by default logger.
+    """
+    state = {"niceness_set": False}
+
+    def compression_task() -> None:
+        """Compress pending recordings to FLAC."""
+        if not state["niceness_set"] and niceness and hasattr(os, "nice"):
+            os.nice(niceness)
+            state["niceness_set"] = True
+
+        pending = find_pending_recordings(directories, min_age=min_age)
+        compressed = 0
+        for path in pending[:max_files]:
+            try:
+                flac_path = encoder.encode(path)
+            except (ValueError, sf.LibsndfileError) as error:
+                logger.error(
+                    "Could not compress %s, it will not be retried: %s",
+                    path,
+                    error,
+                )
+                get_failed_marker(path).write_text(f"{error}\n")
+                continue
+
+            for recording, _ in store.get_recordings_by_path([path]):
+                store.update_recording_path(recording, flac_path)
+
+            path.unlink()
+            compressed += 1
+            logger.debug("Compressed %s to %s", path, flac_path)
+
+        if pending:
+            logger.info(
+                "Compressed %d recordings, %d left",
+                compressed,
+                len(pending) - compressed,
+            )
+
+    return compression_task
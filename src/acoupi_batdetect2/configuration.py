@@ -1,13 +1,16 @@
 """Batdetect2 Program Configuration Options."""
 
 import datetime
+from pathlib import Path
 from typing import Optional
 
 from acoupi.programs.templates import (
     AudioConfiguration,
     DetectionProgramConfiguration,
+    PathsConfiguration,
 )
 from pydantic import BaseModel, Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class BatDetect2_AudioConfig(AudioConfiguration):
@@ -24,12 +27,69 @@ class BatDetect2_AudioConfig(AudioConfiguration):
     """End time for recording schedule."""
 
 
+class BatDetect2_PathsConfig(PathsConfiguration):
+    """Paths Configuration schema."""
+
+    cache: Path = Field(
+        default_factory=lambda: Path.home() / "storages" / "cache",
+    )
+    """Directory for the compiled functions kept across restarts.
+
+    The cache is invalidated automatically when the libraries or the model
+    are updated.
+    """
+
+
 class ModelConfig(BaseModel):
     """Model output configuration."""
 
     detection_threshold: float = 0.4
     """Detection threshold for filtering model outputs."""
 
+    cascade: bool = False
+    """Run the model only on the active time windows of each recording."""
+
+    cascade_activity_threshold: float = 3.0
+    """Standard deviations above the median activity of an active frame."""
+
+    cascade_context: float = 0.05
+    """Context (in seconds) added on each side of the active windows.
+
+    Less context makes the windows narrower, but loses detections at their
+    edges.
+    """
+
+    cascade_max_active_fraction: float = 0.5
+    """Fraction of active frames above which the full recording is run."""
+
+    fast_spectrogram: bool = False
+    """Compute spectrograms with preallocated, reused buffers.
+
+    The FFT runs in double precision to match `librosa`, and the spectrogram
+    is returned in single precision.
+    """
+
+    channel_batch_size: Optional[int] = 1
+    """Maximum number of channels per forward pass. All channels if None.
+
+    On a single CPU core, one pass per channel is faster than a batched pass.
+    """
+
+    prefetch: int = 2
+    """Recordings loaded ahead of the model when processing a backlog."""
+
+    backlog_interval: Optional[float] = 300
+    """Interval (in seconds) between runs of the detection backlog task.
+
+    Each run processes the recordings that have waited longer than one
+    interval without a model output. The backlog is only processed when the
+    program ends if None.
+    """
+
+    preload: bool = False
+    """Load the model in the parent process of the detection worker, so that
+    its forked processes share one copy of the weights."""
+
 
 class SaveRecordingFilter(BaseModel):
     """Saving Filters for audio recordings configuration."""
@@ -91,6 +151,81 @@ class Summariser(BaseModel):
     """Optional high band threshold to summarise detections."""
 
 
+class MetricsConfig(BaseModel):
+    """Operational metrics configuration."""
+
+    db_path: Path = Field(
+        default_factory=lambda: Path.home() / "storages" / "metrics.db",
+    )
+    """Database where the task metrics of all workers are accumulated."""
+
+    textfile: Path = Field(
+        default_factory=lambda: (
+            Path.home() / "storages" / "metrics" / "acoupi_batdetect2.prom"
+        ),
+    )
+    """Prometheus text file with the program metrics."""
+
+    interval: int = 30
+    """Interval (in seconds) between updates of the metrics text file."""
+
+
+class MaintenanceConfig(BaseModel):
+    """Metadata and message store maintenance configuration."""
+
+    interval: int = 60
+    """Interval (in minutes) between maintenance runs.
+
+    The maintenance is skipped while the recording schedule is active.
+    """
+
+    retention_days: Optional[int] = None
+    """Days of recordings, detections and sent messages kept in the stores.
+
+    Older entries are pruned. If None, nothing is pruned.
+    """
+
+    archive_path: Optional[Path] = None
+    """Database where pruned recordings and detections are archived.
+
+    If None, pruned entries are deleted.
+    """
+
+    max_pruned_recordings: int = 10_000
+    """Maximum number of recordings pruned per run."""
+
+    vacuum_pages: int = 2000
+    """Maximum number of free database pages released per run."""
+
+    convert_auto_vacuum: bool = False
+    """Switch the stores to incremental auto vacuum, so that free pages are
+    released.
+
+    The first run rewrites each store with a full `VACUUM`, which needs as
+    much free disk space as the store and can take minutes on large stores.
+    """
+
+
+class CompressionConfig(BaseModel):
+    """Background FLAC compression of the saved recordings."""
+
+    interval: int = 60
+    """Interval (in seconds) between compression runs."""
+
+    max_files: int = 20
+    """Maximum number of recordings compressed per run."""
+
+    min_age: int = 60
+    """Minimum time (in seconds) since a recording was saved.
+
+    Leaves time to the file management task to register the saved path of
+    the recording in the metadata store.
+    """
+
+    niceness: int = 10
+    """Niceness added to the compression worker process."""
+
+
 class BatDetect2_ConfigSchema(DetectionProgramConfiguration):
     """BatDetect2 Program Configuration schema.
 
@@ -104,6 +239,11 @@ class BatDetect2_ConfigSchema(DetectionProgramConfiguration):
     )
     """Audio recording configuration."""
 
+    paths: BatDetect2_PathsConfig = Field(  # type: ignore
+        default_factory=BatDetect2_PathsConfig,
+    )
+    """Data configuration."""
+
     model: ModelConfig = Field(
         default_factory=ModelConfig,
     )
@@ -123,3 +263,49 @@ class BatDetect2_ConfigSchema(DetectionProgramConfiguration):
         default_factory=Summariser,
     )
     """Summariser configuration."""
+
+    metrics: Optional[MetricsConfig] = Field(
+        default_factory=MetricsConfig,
+    )
+    """Operational metrics configuration."""
+
+    maintenance: Optional[MaintenanceConfig] = Field(
+        default_factory=MaintenanceConfig,
+    )
+    """Store maintenance configuration."""
+
+    compression: Optional[CompressionConfig] = None
+    """Background FLAC compression configuration.
+
+    If None, saved recordings are kept as WAV files.
+    """
+
+
+class BatDetect2_WorkerSettings(BaseSettings):
+    """Worker concurrency settings.
+
+    The Celery workers are started from scripts generated before the program
+    configuration is loaded, so these settings are read from environment
+    variables prefixed with `ACOUPI_BATDETECT2_` (e.g.
+    `ACOUPI_BATDETECT2_DETECTION_CONCURRENCY=2`).
+
+    The recording worker always runs with a concurrency of 1 and only listens
+    to the recording queue, so audio capture never waits behind other tasks.
+    """
+
+    model_config = SettingsConfigDict(env_prefix="ACOUPI_BATDETECT2_")
+
+    detection_concurrency: int = 1
+    """Number of concurrent detection tasks (model inference)."""
+
+    management_concurrency: int = 1
+    """Number of concurrent file management tasks."""
+
+    summary_concurrency: int = 1
+    """Number of concurrent summariser tasks."""
+
+    default_concurrency: Optional[int] = None
+    """Number of concurrent messaging and heartbeat tasks.
+
+    If None, the worker will run as many tasks as possible.
+    """
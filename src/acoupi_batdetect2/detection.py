@@ -0,0 +1,153 @@
+"""Pipelined detection of a backlog of recordings.
+
+The detection task of _acoupi_ processes one recording per call, so the
+network waits while each recording is decoded and its spectrogram is
+computed. Recordings pile up in the temporary directory when the
+detection falls behind, when their detection task is lost on a restart,
+or when the program ends. The `detection_backlog_task` periodically runs
+the recordings that have waited longer than `min_age` without a model
+output through `BatDetect2.run_pipelined`, which prepares the next
+recordings in a background thread while the network processes the current
+one.
+
+The model outputs are cleaned, stored and turned into messages in the
+order of the recordings, as done by the detection task. The
+`UnprocessedRecordingFilter` makes the detection tasks still queued for
+these recordings skip them.
+"""
+
+import datetime
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from acoupi import data
+from acoupi.components import types
+
+from acoupi_batdetect2.model import BatDetect2
+
+__all__ = [
+    "UnprocessedRecordingFilter",
+    "generate_pipelined_detection_task",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class UnprocessedRecordingFilter(types.ProcessingFilter):
+    """Only process the recordings without a stored model output.
+
+    Attributes
+    ----------
+    store : types.Store
+        The store of the model outputs.
+    """
+
+    def __init__(self, store: types.Store):
+        """Initialise the unprocessed recording filter."""
+        self.store = store
+
+    def should_process_recording(self, recording: data.Recording) -> bool:
+        """Check that the recording has no model output yet."""
+        return not any(
+            model_outputs
+            for _, model_outputs in self.store.get_recordings([recording.id])
+        )
+
+
+def generate_pipelined_detection_task(
+    store: types.Store,
+    model: BatDetect2,
+    message_store: types.MessageStore,
+    tmp_audio: Path,
+    logger: logging.Logger = logger,
+    output_cleaners: Optional[List[types.ModelOutputCleaner]] = None,
+    processing_filters: Optional[List[types.ProcessingFilter]] = None,
+    message_factories: Optional[List[types.MessageBuilder]] = None,
+    prefetch: int = 2,
+    min_age: float = 0,
+) -> Callable[[], None]:
+    """Generate a task that runs the detection on the pending recordings.
+
+    Parameters
+    ----------
+    store : types.Store
+        The store to store the model outputs.
+    model : BatDetect2
+        The model to run on the recordings.
+    message_store : types.MessageStore
+        The message store to store the messages.
+    tmp_audio : Path
+        The temporary directory where the recordings wait to be processed.
+    logger : logging.Logger, optional
+        The logger to log messages, by default logger.
+    output_cleaners : Optional[List[types.ModelOutputCleaner]], optional
+        The output cleaners to clean the model outputs, by default None.
+    processing_filters : Optional[List[types.ProcessingFilter]], optional
+        The processing filters to check if a recording should be processed,
+        by default None.
+    message_factories : Optional[List[types.MessageBuilder]], optional
+        The message factories to create messages, by default None.
+    prefetch : int
+        Maximum number of recordings loaded ahead of the model.
+    min_age : float
+        Minimum age (in seconds) of the recordings to process. Younger
+        recordings are left to their own detection task.
+    """
+
+    def handle(model_output: data.ModelOutput) -> None:
+        for cleaner in output_cleaners or []:
+            model_output = cleaner.clean(model_output)
+
+        store.store_model_output(model_output)
+
+        for message_factory in message_factories or []:
+            message = message_factory.build_message(model_output)
+            if message is not None:
+                message_store.store_message(message)
+
+    def detection_backlog_task() -> None:
+        """Run the detection process on the pending recordings, in order."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=min_age)
+        recordings = sorted(
+            (
+                recording
+                for recording, model_outputs in store.get_recordings_by_path(
+                    list(tmp_audio.glob("*"))
+                )
+                if not model_outputs and recording.created_on <= cutoff
+            ),
+            key=lambda recording: recording.created_on,
+        )
+        if not recordings:
+            return
+
+        pending = [
+            recording
+            for recording in recordings
+            if all(
+                filter.should_process_recording(recording)
+                for filter in processing_filters or []
+            )
+        ]
+        logger.info(
+            "Running model on %d recordings, %d skipped",
+            len(pending),
+            len(recordings) - len(pending),
+        )
+
+        # A failed recording stops the pipeline, which is restarted from
+        # the next recording.
+        while pending:
+            outputs = model.run_pipelined(list(pending), prefetch)
+            try:
+                for model_output in outputs:
+                    handle(model_output)
+                    pending.pop(0)
+            except Exception:
+                logger.exception("Error processing recording %s", pending[0])
+                pending.pop(0)
+            finally:
+                outputs.close()
+
+    return detection_backlog_task
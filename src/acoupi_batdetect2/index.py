@@ -0,0 +1,424 @@
+"""Time and frequency index of the detections of the BatDetect2 Program.
+
+The metadata store keeps the bounding box of each detection as a JSON
+string, so questions like "all detections between 40 and 60 kHz in the
+last week" require loading and checking every stored detection. The
+`DetectionIndex` keeps an SQLite R*Tree over the absolute time, frequency
+and species of every detection, in the metadata store itself.
+
+The index is maintained by triggers on the predicted tags of the store, so
+it is updated in the same transaction as each stored `ModelOutput`, and
+entries are removed when detections are pruned. The detections stored
+before the index was created are indexed once by `index_stored`.
+
+The R*Tree stores its coordinates as 32-bit floats, rounded outwards. The
+exact values are kept in auxiliary columns and used to filter the candidates
+found by the R*Tree. Times are stored in seconds relative to the moment the
+index was created, as a 32-bit float only has a resolution of about two
+minutes for seconds since 1970. The resolution of the R*Tree is one second
+for detections within about 190 days of the index creation, 2 seconds
+within a year and 8 seconds within four years. Narrower time ranges are
+resolved by the auxiliary columns.
+"""
+
+import datetime
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Union
+from uuid import UUID
+
+from pydantic import BaseModel
+
+__all__ = [
+    "DetectionIndex",
+    "IndexedDetection",
+]
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Seconds since the epoch of a datetime stored by Pony, with millisecond
+# precision. Computed from the whole seconds and the fraction separately,
+# as a julian day only has a precision of tens of microseconds.
+RECORDING_TIME = (
+    "(strftime('%s', recording.datetime) "
+    "+ strftime('%f', recording.datetime) "
+    "- strftime('%S', recording.datetime))"
+)
+
+# Only valid bounding boxes are indexed, so that a malformed location
+# never makes the insertion of a model output fail.
+LOCATION_IS_BOX = """
+CASE WHEN json_valid(detection.location) THEN
+    json_extract(detection.location, '$.type') = 'BoundingBox'
+    AND json_extract(detection.location, '$.coordinates[0]')
+        <= json_extract(detection.location, '$.coordinates[2]')
+    AND json_extract(detection.location, '$.coordinates[1]')
+        <= json_extract(detection.location, '$.coordinates[3]')
+ELSE 0 END
+"""
+
+CREATE_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS detection_index USING rtree(
+    id,
+    min_time, max_time,
+    min_freq, max_freq,
+    min_species, max_species,
+    +detection_id,
+    +recording_id,
+    +species,
+    +start_time,
+    +end_time,
+    +low_freq,
+    +high_freq,
+    +detection_score,
+    +confidence_score
+)
+"""
+
+CREATE_SPECIES = """
+CREATE TABLE IF NOT EXISTS detection_index_species (
+    code INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+)
+"""
+
+# Origin (in seconds since the epoch) of the times stored in the R*Tree,
+# and whether the detections stored before the index have been indexed.
+CREATE_ORIGIN = """
+CREATE TABLE IF NOT EXISTS detection_index_origin (
+    seconds REAL NOT NULL,
+    indexed_stored INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+INSERT_ORIGIN = """
+INSERT INTO detection_index_origin (seconds)
+SELECT ? WHERE NOT EXISTS (SELECT 1 FROM detection_index_origin)
+"""
+
+# Index entries of the species tags selected as `tag`.
+SELECT_ENTRIES = f"""
+SELECT
+    tag.id,
+    {RECORDING_TIME} + json_extract(detection.location, '$.coordinates[0]')
+        - origin.seconds,
+    {RECORDING_TIME} + json_extract(detection.location, '$.coordinates[2]')
+        - origin.seconds,
+    json_extract(detection.location, '$.coordinates[1]'),
+    json_extract(detection.location, '$.coordinates[3]'),
+    species.code,
+    species.code,
+    detection.id,
+    recording.id,
+    tag.value,
+    {RECORDING_TIME} + json_extract(detection.location, '$.coordinates[0]'),
+    {RECORDING_TIME} + json_extract(detection.location, '$.coordinates[2]'),
+    json_extract(detection.location, '$.coordinates[1]'),
+    json_extract(detection.location, '$.coordinates[3]'),
+    detection.detection_score,
+    tag.confidence_score
+FROM {{source}}
+JOIN detection ON detection.id = tag.detection_id
+JOIN model_output ON model_output.id = detection.model_output_id
+JOIN recording ON recording.id = model_output.recording_id
+JOIN detection_index_species AS species ON species.name = tag.value
+JOIN detection_index_origin AS origin
+WHERE tag.key = 'species' AND {LOCATION_IS_BOX}
+"""
+
+# The trigger statements refer to the new row as NEW, which can not be
+# aliased, so it is selected through a subquery.
+NEW_TAG = (
+    "(SELECT NEW.id AS id, NEW.key AS key, NEW.value AS value, "
+    "NEW.confidence_score AS confidence_score, "
+    "NEW.detection_id AS detection_id) AS tag"
+)
+
+TABLE_NAMES = [
+    "detection_index",
+    "detection_index_species",
+    "detection_index_origin",
+    "detection_index_insert",
+    "detection_index_update",
+    "detection_index_delete",
+]
+
+CREATE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS detection_index_insert
+    AFTER INSERT ON predicted_tag
+    WHEN NEW.key = 'species' AND NEW.detection_id IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO detection_index_species (name)
+        VALUES (NEW.value);
+        INSERT INTO detection_index
+        {SELECT_ENTRIES.format(source=NEW_TAG)};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS detection_index_update
+    AFTER UPDATE OF key, value, detection_id ON predicted_tag
+    BEGIN
+        DELETE FROM detection_index WHERE id = OLD.id;
+        INSERT OR IGNORE INTO detection_index_species (name)
+        SELECT NEW.value WHERE NEW.key = 'species';
+        INSERT INTO detection_index
+        {SELECT_ENTRIES.format(source=NEW_TAG)};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS detection_index_delete
+    AFTER DELETE ON predicted_tag
+    BEGIN
+        DELETE FROM detection_index WHERE id = OLD.id;
+    END
+    """,
+]
+
+
+class IndexedDetection(BaseModel):
+    """A detection found in the index."""
+
+    detection_id: UUID
+    recording_id: UUID
+    species: str
+    start_time: datetime.datetime
+    end_time: datetime.datetime
+    low_freq: float
+    high_freq: float
+    detection_score: float
+    confidence_score: float
+
+
+def _to_seconds(value: datetime.datetime) -> float:
+    # Stored datetimes without timezone are read as UTC by SQLite.
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH).total_seconds()
+
+
+def _to_datetime(seconds: float) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class DetectionIndex:
+    """R*Tree index of the detections in the metadata store.
+
+    Attributes
+    ----------
+    db_path : Path
+        The metadata store database.
+    """
+
+    def __init__(self, db_path: Path):
+        """Initialise the detection index."""
+        self.db_path = db_path
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            isolation_level=None,
+        )
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def create(self) -> None:
+        """Create the index and its triggers, if missing.
+
+        Must be called after the metadata store has been created. Only takes
+        a write lock on the store when part of the index is missing.
+        """
+        with self._connect() as connection:
+            placeholders = ", ".join("?" * len(TABLE_NAMES))
+            (count,) = connection.execute(
+                "SELECT count(*) FROM sqlite_master "
+                f"WHERE name IN ({placeholders})",
+                TABLE_NAMES,
+            ).fetchone()
+            if count == len(TABLE_NAMES):
+                return
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(CREATE_SPECIES)
+                connection.execute(CREATE_ORIGIN)
+                connection.execute(
+                    INSERT_ORIGIN,
+                    (float(round(time.time())),),
+                )
+                connection.execute(CREATE_INDEX)
+                for trigger in CREATE_TRIGGERS:
+                    connection.execute(trigger)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def index_stored(self) -> None:
+        """Index the detections stored before the index was created.
+
+        Only runs once per store. The detections already indexed by the
+        triggers are skipped.
+        """
+        with self._connect() as connection:
+            (indexed,) = connection.execute(
+                "SELECT indexed_stored FROM detection_index_origin"
+            ).fetchone()
+            if indexed:
+                return
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR IGNORE INTO detection_index_species (name) "
+                    "SELECT DISTINCT value FROM predicted_tag "
+                    "WHERE key = 'species' AND detection_id IS NOT NULL"
+                )
+                connection.execute(
+                    "INSERT INTO detection_index "
+                    + SELECT_ENTRIES.format(source="predicted_tag AS tag")
+                    + "AND tag.id NOT IN (SELECT id FROM detection_index)"
+                )
+                connection.execute(
+                    "UPDATE detection_index_origin SET indexed_stored = 1"
+                )
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def _get_origin(self) -> float:
+        with self._connect() as connection:
+            (origin,) = connection.execute(
+                "SELECT seconds FROM detection_index_origin"
+            ).fetchone()
+        return origin
+
+    def query(
+        self,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        low_freq: Optional[float] = None,
+        high_freq: Optional[float] = None,
+        species: Union[str, Sequence[str], None] = None,
+        min_score: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> List[IndexedDetection]:
+        """Find the detections overlapping a time and frequency range.
+
+        Parameters
+        ----------
+        start : datetime.datetime, optional
+            Only detections that end after this time are returned.
+        end : datetime.datetime, optional
+            Only detections that start before this time are returned.
+        low_freq : float, optional
+            Only detections whose highest frequency (in Hz) is above this
+            frequency are returned.
+        high_freq : float, optional
+            Only detections whose lowest frequency (in Hz) is below this
+            frequency are returned.
+        species : str or Sequence[str], optional
+            Only detections of these species are returned.
+        min_score : float, optional
+            Only detections with a detection score of at least this value
+            are returned.
+        limit : int, optional
+            Maximum number of detections returned.
+
+        Returns
+        -------
+        List[IndexedDetection]
+            The detections, sorted by start time.
+        """
+        conditions = []
+        params: list = []
+        origin = self._get_origin()
+
+        if start is not None:
+            conditions.append("max_time >= ? AND end_time >= ?")
+            params.extend([_to_seconds(start) - origin, _to_seconds(start)])
+
+        if end is not None:
+            conditions.append("min_time <= ? AND start_time <= ?")
+            params.extend([_to_seconds(end) - origin, _to_seconds(end)])
+
+        if low_freq is not None:
+            conditions.append("max_freq >= ? AND high_freq >= ?")
+            params.extend([low_freq] * 2)
+
+        if high_freq is not None:
+            conditions.append("min_freq <= ? AND low_freq <= ?")
+            params.extend([high_freq] * 2)
+
+        if min_score is not None:
+            conditions.append("detection_score >= ?")
+            params.append(min_score)
+
+        with self._connect() as connection:
+            if species is not None:
+                if isinstance(species, str):
+                    species = [species]
+
+                codes = [
+                    code
+                    for (code,) in connection.execute(
+                        "SELECT code FROM detection_index_species "
+                        f"WHERE name IN ({', '.join('?' * len(species))})",
+                        list(species),
+                    )
+                ]
+                if not codes:
+                    return []
+
+                placeholders = ", ".join("?" * len(codes))
+                conditions.append(
+                    "min_species >= ? AND max_species <= ? "
+                    f"AND min_species IN ({placeholders})"
+                )
+                params.extend([min(codes), max(codes), *codes])
+
+            sql = (
+                "SELECT detection_id, recording_id, species, start_time, "
+                "end_time, low_freq, high_freq, detection_score, "
+                "confidence_score FROM detection_index"
+            )
+            if conditions:
+                sql += " WHERE " + " AND ".join(conditions)
+            sql += " ORDER BY start_time"
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(limit)
+
+            rows = connection.execute(sql, params).fetchall()
+
+        return [
+            IndexedDetection(
+                detection_id=UUID(bytes=detection_id),
+                recording_id=UUID(bytes=recording_id),
+                species=species_name,
+                start_time=_to_datetime(start_time),
+                end_time=_to_datetime(end_time),
+                low_freq=low,
+                high_freq=high,
+                detection_score=detection_score,
+                confidence_score=confidence_score,
+            )
+            for (
+                detection_id,
+                recording_id,
+                species_name,
+                start_time,
+                end_time,
+                low,
+                high,
+                detection_score,
+                confidence_score,
+            ) in rows
+        ]
@@ -0,0 +1,398 @@
+"""Maintenance of the BatDetect2 Program stores.
+
+The metadata and message stores are SQLite databases that grow with every
+recording, detection and message. Over months of deployment the queries
+made by the summarisers and the messaging task slow down and the stores
+fill the SD card. This module provides maintainers that keep the stores
+small and fast:
+
+- Indexes on the columns used by the summariser and message queries.
+- Pruning (or archiving) of the entries older than a retention window.
+- Incremental `VACUUM`, which returns a bounded number of free pages to
+the file system at each run, and `ANALYZE`, which keeps the query planner
+statistics up to date. The stores created by _acoupi_ do not support
+incremental vacuum. Switching them to it rewrites the whole database
+with a full `VACUUM`, so it is only done when `convert_auto_vacuum` is set.
+Otherwise the free pages stay in the file and are reused by new entries.
+
+The `maintenance_task` only runs outside of the recording schedule, so
+that it does not compete with the recording and detection tasks.
+"""
+
+import datetime
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from acoupi.components import SqliteStore, types
+
+__all__ = [
+    "MessageStoreMaintainer",
+    "MetadataStoreMaintainer",
+    "SqliteMaintainer",
+    "generate_maintenance_task",
+]
+
+logger = logging.getLogger(__name__)
+
+# SQLite value of `PRAGMA auto_vacuum` for incremental vacuum.
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Number of rows sampled per index by `ANALYZE`, to bound its run time.
+ANALYSIS_LIMIT = 1000
+
+
+class SqliteMaintainer(ABC):
+    """Base maintainer of a SQLite database.
+
+    Subclasses define the indexes to create and how to prune old entries.
+    """
+
+    indexes: Tuple[Tuple[str, str, str], ...] = ()
+    """Indexes to create, as (name, table, columns) tuples."""
+
+    def __init__(self, db_path: Path):
+        """Initialise the maintainer."""
+        self.db_path = db_path
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Autocommit mode, as VACUUM can not run inside a transaction.
+        # Transactions are opened explicitly when needed.
+        connection = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            isolation_level=None,
+        )
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def create_indexes(self) -> None:
+        """Create the missing indexes."""
+        with self._connect() as connection:
+            for name, table, columns in self.indexes:
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+                )
+
+    @abstractmethod
+    def prune(self, before: datetime.datetime) -> int:
+        """Remove the entries created before the given datetime.
+
+        Returns
+        -------
+        int
+            The number of pruned entries.
+        """
+
+    def compact(self, pages: int, convert_auto_vacuum: bool = False) -> int:
+        """Return up to `pages` free pages to the file system.
+
+        Only databases in incremental auto vacuum mode release free pages.
+        If `convert_auto_vacuum` is set, other databases are switched to it,
+        which requires a full `VACUUM` on the first run. The following runs
+        only release a bounded number of free pages.
+
+        Returns
+        -------
+        int
+            The number of free pages left in the database.
+        """
+        with self._connect() as connection:
+            (mode,) = connection.execute("PRAGMA auto_vacuum").fetchone()
+            if mode != AUTO_VACUUM_INCREMENTAL:
+                if convert_auto_vacuum:
+                    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                    connection.execute("VACUUM")
+            else:
+                connection.execute(
+                    f"PRAGMA incremental_vacuum({int(pages)})"
+                ).fetchall()
+
+            (free_pages,) = connection.execute(
+                "PRAGMA freelist_count"
+            ).fetchone()
+            return free_pages
+
+    def analyze(self) -> None:
+        """Update the query planner statistics."""
+        with self._connect() as connection:
+            connection.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+            connection.execute("ANALYZE")
+
+
+def _format_datetime(value: datetime.datetime) -> str:
+    # Datetimes are stored by Pony as ISO strings with a space separator.
+    return value.isoformat(sep=" ")
+
+
+class MetadataStoreMaintainer(SqliteMaintainer):
+    """Maintainer of the metadata store.
+
+    Recordings older than the retention window are pruned together with
+    their model outputs, detections and predicted tags. If an archive path
+    is given, the pruned entries are first copied to an archive database
+    with the same schema. Audio files are not modified.
+    """
+
+    indexes = (
+        (
+            "idx_model_output__created_on",
+            "model_output",
+            "created_on",
+        ),
+        (
+            "idx_detection__detection_score",
+            "detection",
+            "detection_score",
+        ),
+        (
+            "idx_predicted_tag__confidence_score",
+            "predicted_tag",
+            "confidence_score",
+        ),
+    )
+
+    def __init__(
+        self,
+        db_path: Path,
+        archive_path: Optional[Path] = None,
+        max_recordings: int = 10_000,
+    ):
+        """Initialise the metadata store maintainer."""
+        super().__init__(db_path)
+        self.archive_path = archive_path
+        self.max_recordings = max_recordings
+        self._archive_created = False
+
+    def _create_archive(self) -> None:
+        if self._archive_created:
+            return
+
+        # The archive has the same schema as the metadata store.
+        SqliteStore(self.archive_path)  # type: ignore
+        self._archive_created = True
+
+    def prune(self, before: datetime.datetime) -> int:
+        """Prune the recordings made before the given datetime.
+
+        At most `max_recordings` recordings, the oldest first, are pruned
+        per call so that the store is never locked for long.
+
+        Returns
+        -------
+        int
+            The number of pruned recordings.
+        """
+        with self._connect() as connection:
+            if self.archive_path is not None:
+                self._create_archive()
+                connection.execute(
+                    "ATTACH DATABASE ? AS archive",
+                    (str(self.archive_path),),
+                )
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                pruned = self._prune(connection, before)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+        return pruned
+
+    def _prune(
+        self,
+        connection: sqlite3.Connection,
+        before: datetime.datetime,
+    ) -> int:
+        connection.execute(
+            "CREATE TEMP TABLE expired_recording AS "
+            "SELECT id FROM recording WHERE datetime < ? "
+            "ORDER BY datetime LIMIT ?",
+            (_format_datetime(before), self.max_recordings),
+        )
+        connection.execute(
+            "CREATE TEMP TABLE expired_model_output AS "
+            "SELECT id FROM model_output "
+            "WHERE recording_id IN (SELECT id FROM expired_recording)"
+        )
+        connection.execute(
+            "CREATE TEMP TABLE expired_detection AS "
+            "SELECT id FROM detection "
+            "WHERE model_output_id IN (SELECT id FROM expired_model_output)"
+        )
+
+        tables = [
+            (
+                "deployment",
+                "id IN (SELECT deployment_id FROM recording "
+                "WHERE id IN (SELECT id FROM expired_recording))",
+            ),
+            ("recording", "id IN (SELECT id FROM expired_recording)"),
+            ("model_output", "id IN (SELECT id FROM expired_model_output)"),
+            ("detection", "id IN (SELECT id FROM expired_detection)"),
+            (
+                "predicted_tag",
+                "detection_id IN (SELECT id FROM expired_detection) "
+                "OR model_output_id IN (SELECT id FROM expired_model_output)",
+            ),
+        ]
+
+        if self.archive_path is not None:
+            for table, condition in tables:
+                connection.execute(
+                    f"INSERT OR IGNORE INTO archive.{table} "
+                    f"SELECT * FROM main.{table} WHERE {condition}"
+                )
+
+        (pruned,) = connection.execute(
+            "SELECT COUNT(*) FROM expired_recording"
+        ).fetchone()
+
+        # Delete children first, deployments are kept.
+        for table, condition in reversed(tables[1:]):
+            connection.execute(f"DELETE FROM main.{table} WHERE {condition}")
+
+        connection.execute("DROP TABLE temp.expired_detection")
+        connection.execute("DROP TABLE temp.expired_model_output")
+        connection.execute("DROP TABLE temp.expired_recording")
+        return pruned
+
+
+class MessageStoreMaintainer(SqliteMaintainer):
+    """Maintainer of the message store.
+
+    Messages that were sent successfully and are older than the retention
+    window are deleted. Unsent messages are always kept.
+    """
+
+    indexes = (
+        (
+            "idx_response__message_id_status",
+            "response",
+            "message_id, status",
+        ),
+        (
+            "idx_message__created_on",
+            "message",
+            "created_on",
+        ),
+    )
+
+    def prune(self, before: datetime.datetime) -> int:
+        """Delete the sent messages created before the given datetime.
+
+        Returns
+        -------
+        int
+            The number of deleted messages.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "CREATE TEMP TABLE expired_message AS "
+                    "SELECT id FROM message WHERE created_on < ? "
+                    "AND EXISTS (SELECT 1 FROM response "
+                    "WHERE response.message_id = message.id "
+                    "AND response.status = 0)",
+                    (_format_datetime(before),),
+                )
+                connection.execute(
+                    "DELETE FROM response "
+                    "WHERE message_id IN (SELECT id FROM expired_message)"
+                )
+                cursor = connection.execute(
+                    "DELETE FROM message "
+                    "WHERE id IN (SELECT id FROM expired_message)"
+                )
+                connection.execute("DROP TABLE temp.expired_message")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+        return cursor.rowcount
+
+
+def generate_maintenance_task(
+    maintainers: List[SqliteMaintainer],
+    recording_conditions: List[types.RecordingCondition],
+    retention: Optional[datetime.timedelta] = None,
+    vacuum_pages: int = 2000,
+    convert_auto_vacuum: bool = False,
+    logger: logging.Logger = logger,
+) -> Callable[[], None]:
+    """Generate a store maintenance task.
+
+    Parameters
+    ----------
+    maintainers : List[SqliteMaintainer]
+        The maintainers of the stores.
+    recording_conditions : List[types.RecordingCondition]
+        The recording conditions of the program. As in the recording task,
+        the program records while all of them hold, and the maintenance is
+        skipped during that time.
+    retention : datetime.timedelta, optional
+        Entries older than this are pruned. If None, nothing is pruned.
+    vacuum_pages : int
+        Maximum number of free pages released per store and run.
+    convert_auto_vacuum : bool
+        Switch the stores to incremental auto vacuum, with a full `VACUUM`
+        of each store on the first run.
+    logger : logging.Logger, optional
+        The logger to log messages, by default logger.
+    """
+
+    def maintenance_task() -> None:
+        """Index, prune and compact the stores outside recording hours."""
+        if recording_conditions and all(
+            condition.should_record() for condition in recording_conditions
+        ):
+            logger.debug("Recording schedule is active, skipping maintenance.")
+            return
+
+        before = None
+        if retention is not None:
+            before = datetime.datetime.now() - retention
+
+        for maintainer in maintainers:
+            try:
+                maintainer.create_indexes()
+
+                if before is not None:
+                    pruned = maintainer.prune(before)
+                    logger.info(
+                        "Pruned %d entries older than %s from %s",
+                        pruned,
+                        before,
+                        maintainer.db_path,
+                    )
+
+                free_pages = maintainer.compact(
+                    vacuum_pages,
+                    convert_auto_vacuum=convert_auto_vacuum,
+                )
+                maintainer.analyze()
+            except sqlite3.Error as error:
+                logger.error(
+                    "Error maintaining %s: %s",
+                    maintainer.db_path,
+                    error,
+                )
+                continue
+
+            logger.debug(
+                "Maintained %s, %d free pages left",
+                maintainer.db_path,
+                free_pages,
+            )
+
+    return maintenance_task
@@ -0,0 +1,678 @@
+"""Operational metrics for the BatDetect2 Program.
+
+The program tasks run in several Celery worker processes, so the task
+metrics are accumulated in a small SQLite database shared by all of them.
+Each worker records, through Celery signals, when a task is queued,
+started and finished, and how long it ran. A periodic `metrics_task`
+reads the accumulated task metrics, measures the backlog of the program
+(pending temporary recordings, size of the metadata store and unsent
+messages) and writes everything to a file in the Prometheus text format.
+
+After each task run, the worker process also records its memory usage.
+The resident set size (RSS) counts the pages shared with other processes,
+such as the model weights loaded before forking, in every process that
+uses them, so the proportional set size (PSS) and the size of the shared
+pages are reported too.
+
+Point the `metrics.textfile` configuration to the textfile collector
+directory of the Prometheus node exporter (e.g.
+`/var/lib/node_exporter/textfile_collector/acoupi_batdetect2.prom`) to
+scrape the metrics.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from acoupi.system.files import get_temp_files
+from celery import signals
+from pydantic import BaseModel
+
+__all__ = [
+    "DURATION_BUCKETS",
+    "MemoryUsage",
+    "MetricsStore",
+    "TaskMetrics",
+    "TaskMetricsRecorder",
+    "WorkerMemory",
+    "generate_metrics_task",
+    "read_memory_usage",
+    "render_metrics",
+]
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "acoupi_batdetect2"
+
+DURATION_BUCKETS: Tuple[float, ...] = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    math.inf,
+)
+"""Upper bounds (in seconds) of the task duration histogram buckets."""
+
+
+class TaskMetrics(BaseModel):
+    """Accumulated metrics of a task."""
+
+    task: str
+    """Name of the task."""
+
+    published: int = 0
+    """Number of times the task was sent to its queue."""
+
+    started: int = 0
+    """Number of task runs that started."""
+
+    finished: int = 0
+    """Number of task runs that finished, successfully or not."""
+
+    failures: int = 0
+    """Number of task runs that raised an error."""
+
+    duration_sum: float = 0
+    """Total run time (in seconds) of the finished task runs."""
+
+    buckets: List[int]
+    """Number of finished task runs per duration bucket."""
+
+    @property
+    def queued(self) -> int:
+        """Number of task runs waiting in the queue."""
+        return max(self.published - self.started, 0)
+
+
+class MemoryUsage(BaseModel):
+    """Memory usage of a process, in bytes."""
+
+    rss: int
+    """Resident set size."""
+
+    pss: int
+    """Proportional set size: the private memory of the process plus its
+    share of the memory shared with other processes."""
+
+    shared: int
+    """Resident memory shared with other processes."""
+
+
+class WorkerMemory(MemoryUsage):
+    """Last recorded memory usage of a worker process."""
+
+    worker: str
+    """Name of the Celery worker."""
+
+    pid: int
+    """Process id of the worker process."""
+
+
+def _read_proc_fields(path: str) -> Dict[str, int]:
+    # Fields given in kB, as in "Rss:  1234 kB".
+    fields = {}
+    with open(path) as proc_file:
+        for line in proc_file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return fields
+
+
+def read_memory_usage() -> MemoryUsage:
+    """Read the memory usage of the current process.
+
+    Uses `/proc/self/smaps_rollup`, available since Linux 4.14. On older
+    kernels the PSS is not known and the RSS is reported instead.
+    """
+    try:
+        fields = _read_proc_fields("/proc/self/smaps_rollup")
+        return MemoryUsage(
+            rss=fields["Rss"],
+            pss=fields["Pss"],
+            shared=fields["Shared_Clean"] + fields["Shared_Dirty"],
+        )
+    except (OSError, KeyError):
+        pass
+
+    fields = _read_proc_fields("/proc/self/status")
+    rss = fields["VmRSS"]
+    shared = fields.get("RssFile", 0) + fields.get("RssShmem", 0)
+    return MemoryUsage(rss=rss, pss=rss, shared=shared)
+
+
+class MetricsStore:
+    """Task metrics shared by all the program processes.
+
+    Each process keeps its own connection to the database, opened on first
+    use and opened again after the worker processes are forked. Every update
+    is a single short transaction. The database uses a write-ahead log with
+    `synchronous=NORMAL`, so commits are not synced to disk, only the
+    periodic checkpoints are. A power cut may lose the last updates, but
+    never corrupts the database.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ):
+        """Initialise the metrics store and create its tables."""
+        self.path = path
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._inherited: List[sqlite3.Connection] = []
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS task_metrics ("
+                "task TEXT PRIMARY KEY, "
+                "published INTEGER NOT NULL DEFAULT 0, "
+                "started INTEGER NOT NULL DEFAULT 0, "
+                "finished INTEGER NOT NULL DEFAULT 0, "
+                "failures INTEGER NOT NULL DEFAULT 0, "
+                "duration_sum REAL NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS task_durations ("
+                "task TEXT NOT NULL, "
+                "bucket INTEGER NOT NULL, "
+                "count INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (task, bucket))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS worker_memory ("
+                "pid INTEGER PRIMARY KEY, "
+                "worker TEXT NOT NULL, "
+                "rss INTEGER NOT NULL, "
+                "pss INTEGER NOT NULL, "
+                "shared INTEGER NOT NULL)"
+            )
+
+        # Do not carry the connection into the forked worker processes.
+        self.reopen()
+
+    def reopen(self) -> None:
+        """Open a new connection on next use.
+
+        Must be called in each worker process after it is forked.
+        """
+        with self._lock:
+            if self._connection is not None and self._pid != os.getpid():
+                # A connection inherited from the parent process must not be
+                # used or closed, as it shares its file with the parent.
+                self._inherited.append(self._connection)
+            elif self._connection is not None:
+                self._connection.close()
+
+            self._connection = None
+            self._pid = None
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid():
+                if self._connection is not None:
+                    self._inherited.append(self._connection)
+
+                self._connection = sqlite3.connect(
+                    self.path,
+                    timeout=5,
+                    check_same_thread=False,
+                )
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+                self._pid = os.getpid()
+
+            with self._connection:
+                yield self._connection
+
+    def _increment(self, task: str, column: str) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                f"INSERT INTO task_metrics (task, {column}) VALUES (?, 1) "
+                f"ON CONFLICT (task) DO UPDATE SET {column} = {column} + 1",
+                (task,),
+            )
+
+    def record_published(self, task: str) -> None:
+        """Record that a task was sent to its queue."""
+        self._increment(task, "published")
+
+    def record_started(self, task: str) -> None:
+        """Record that a task run started."""
+        self._increment(task, "started")
+
+    def record_finished(
+        self,
+        task: str,
+        duration: float,
+        failed: bool = False,
+        memory: Optional[WorkerMemory] = None,
+    ) -> None:
+        """Record that a task run finished after `duration` seconds.
+
+        The memory usage of the worker process after the run, if given, is
+        recorded in the same transaction.
+        """
+        bucket = next(
+            index
+            for index, upper in enumerate(self.buckets)
+            if duration <= upper or index == len(self.buckets) - 1
+        )
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO task_metrics "
+                "(task, finished, failures, duration_sum) "
+                "VALUES (?, 1, ?, ?) "
+                "ON CONFLICT (task) DO UPDATE SET "
+                "finished = finished + 1, "
+                "failures = failures + excluded.failures, "
+                "duration_sum = duration_sum + excluded.duration_sum",
+                (task, int(failed), duration),
+            )
+            connection.execute(
+                "INSERT INTO task_durations (task, bucket, count) "
+                "VALUES (?, ?, 1) "
+                "ON CONFLICT (task, bucket) DO UPDATE SET count = count + 1",
+                (task, bucket),
+            )
+            if memory is not None:
+                self._insert_memory(connection, memory)
+
+    def get_task_metrics(self) -> List[TaskMetrics]:
+        """Get the accumulated metrics of every task, sorted by name."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT task, published, started, finished, failures, "
+                "duration_sum FROM task_metrics ORDER BY task"
+            ).fetchall()
+            durations = connection.execute(
+                "SELECT task, bucket, count FROM task_durations"
+            ).fetchall()
+
+        buckets: Dict[str, List[int]] = {
+            row[0]: [0] * len(self.buckets) for row in rows
+        }
+        for task, bucket, count in durations:
+            if task in buckets and bucket < len(self.buckets):
+                buckets[task][bucket] = count
+
+        return [
+            TaskMetrics(
+                task=task,
+                published=published,
+                started=started,
+                finished=finished,
+                failures=failures,
+                duration_sum=duration_sum,
+                buckets=buckets[task],
+            )
+            for task, published, started, finished, failures, duration_sum in rows
+        ]
+
+    def record_memory(self, memory: WorkerMemory) -> None:
+        """Record the current memory usage of a worker process."""
+        with self._connect() as connection:
+            self._insert_memory(connection, memory)
+
+    def _insert_memory(
+        self,
+        connection: sqlite3.Connection,
+        memory: WorkerMemory,
+    ) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO worker_memory "
+            "(pid, worker, rss, pss, shared) VALUES (?, ?, ?, ?, ?)",
+            (
+                memory.pid,
+                memory.worker,
+                memory.rss,
+                memory.pss,
+                memory.shared,
+            ),
+        )
+
+    def get_worker_memory(self) -> List[WorkerMemory]:
+        """Get the last memory usage of every worker process."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT worker, pid, rss, pss, shared FROM worker_memory "
+                "ORDER BY worker, pid"
+            ).fetchall()
+
+        return [
+            WorkerMemory(
+                worker=worker, pid=pid, rss=rss, pss=pss, shared=shared
+            )
+            for worker, pid, rss, pss, shared in rows
+        ]
+
+    def remove_worker_memory(self, pids: Sequence[int]) -> None:
+        """Remove the memory usage of worker processes that exited."""
+        with self._connect() as connection:
+            connection.executemany(
+                "DELETE FROM worker_memory WHERE pid = ?",
+                [(pid,) for pid in pids],
+            )
+
+
+class TaskMetricsRecorder:
+    """Record the metrics of the program tasks from Celery signals.
+
+    Only the tasks in `tasks` are recorded. Errors while writing the
+    metrics are logged and never interrupt the task.
+    """
+
+    def __init__(self, store: MetricsStore, tasks: Mapping):
+        """Initialise the recorder."""
+        self.store = store
+        self.tasks = tasks
+        self._started: Dict[str, float] = {}
+
+    def connect(self) -> None:
+        """Start recording the task metrics."""
+        signals.before_task_publish.connect(self.on_publish)
+        signals.task_prerun.connect(self.on_prerun)
+        signals.task_postrun.connect(self.on_postrun)
+        signals.worker_process_init.connect(self.on_worker_process_init)
+
+    def disconnect(self) -> None:
+        """Stop recording the task metrics."""
+        signals.before_task_publish.disconnect(self.on_publish)
+        signals.task_prerun.disconnect(self.on_prerun)
+        signals.task_postrun.disconnect(self.on_postrun)
+        signals.worker_process_init.disconnect(self.on_worker_process_init)
+
+    def on_worker_process_init(self, **kwargs) -> None:
+        self.store.reopen()
+
+    def on_publish(self, sender=None, **kwargs) -> None:
+        if sender not in self.tasks:
+            return
+
+        self._record(self.store.record_published, sender)
+
+    def on_prerun(self, task_id=None, task=None, **kwargs) -> None:
+        if task is None or task.name not in self.tasks:
+            return
+
+        self._started[task_id] = time.monotonic()
+        self._record(self.store.record_started, task.name)
+
+    def on_postrun(self, task_id=None, task=None, state=None, **kwargs):
+        if task is None or task.name not in self.tasks:
+            return
+
+        started = self._started.pop(task_id, None)
+        if started is None:
+            return
+
+        duration = time.monotonic() - started
+        self._record(
+            self.store.record_finished,
+            task.name,
+            duration,
+            state == "FAILURE",
+            self._read_memory(task),
+        )
+
+    def _read_memory(self, task) -> Optional[WorkerMemory]:
+        try:
+            memory = read_memory_usage()
+        except (OSError, KeyError) as error:
+            logger.warning("Could not read the memory usage: %s", error)
+            return None
+
+        return WorkerMemory(
+            worker=getattr(task.request, "hostname", None) or "unknown",
+            pid=os.getpid(),
+            **memory.model_dump(),
+        )
+
+    def _record(self, method: Callable, *args) -> None:
+        try:
+            method(*args)
+        except sqlite3.Error as error:
+            logger.warning("Could not record task metrics: %s", error)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def render_metrics(
+    task_metrics: Sequence[TaskMetrics],
+    gauges: Mapping[str, Tuple[str, float]],
+    buckets: Sequence[float] = DURATION_BUCKETS,
+    worker_memory: Optional[Sequence[WorkerMemory]] = None,
+) -> str:
+    """Render metrics in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    task_metrics : Sequence[TaskMetrics]
+        The accumulated metrics of each task.
+    gauges : Mapping[str, Tuple[str, float]]
+        Program level gauges, as a mapping from the metric name (without
+        prefix) to its help text and value.
+    buckets : Sequence[float]
+        Upper bounds of the task duration histogram buckets.
+    worker_memory : Sequence[WorkerMemory], optional
+        The last memory usage of each worker process.
+
+    Returns
+    -------
+    str
+        The metrics, with every metric name prefixed with
+        `acoupi_batdetect2_`.
+    """
+    lines = []
+
+    def header(name: str, kind: str, help: str) -> None:
+        lines.append(f"# HELP {PREFIX}_{name} {help}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+    counters = [
+        ("task_published_total", "published", "Task runs sent to a queue."),
+        ("task_runs_total", "finished", "Task runs that finished."),
+        ("task_failures_total", "failures", "Task runs that failed."),
+        ("task_queued", "queued", "Task runs waiting in a queue."),
+    ]
+    for name, attribute, help in counters:
+        header(name, "gauge" if name == "task_queued" else "counter", help)
+        for metrics in task_metrics:
+            value = getattr(metrics, attribute)
+            lines.append(f'{PREFIX}_{name}{{task="{metrics.task}"}} {value}')
+
+    header(
+        "task_duration_seconds",
+        "histogram",
+        "Run time of the tasks in seconds.",
+    )
+    for metrics in task_metrics:
+        label = f'task="{metrics.task}"'
+        cumulative = 0
+        for upper, count in zip(buckets, metrics.buckets):
+            cumulative += count
+            lines.append(
+                f"{PREFIX}_task_duration_seconds_bucket"
+                f'{{{label},le="{_format_value(upper)}"}} {cumulative}'
+            )
+        lines.append(
+            f"{PREFIX}_task_duration_seconds_sum{{{label}}} "
+            f"{_format_value(metrics.duration_sum)}"
+        )
+        lines.append(
+            f"{PREFIX}_task_duration_seconds_count{{{label}}} "
+            f"{metrics.finished}"
+        )
+
+    for name, (help, value) in gauges.items():
+        header(name, "gauge", help)
+        lines.append(f"{PREFIX}_{name} {_format_value(value)}")
+
+    if worker_memory:
+        header(
+            "worker_memory_bytes",
+            "gauge",
+            "Memory used by the worker processes, by type (rss, pss or "
+            "shared).",
+        )
+        for memory in worker_memory:
+            for kind in ["rss", "pss", "shared"]:
+                lines.append(
+                    f"{PREFIX}_worker_memory_bytes"
+                    f'{{worker="{memory.worker}",pid="{memory.pid}",'
+                    f'type="{kind}"}} {getattr(memory, kind)}'
+                )
+
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: Path, content: str) -> None:
+    """Write the metrics file atomically.
+
+    The content is written to a hidden temporary file first, so that the
+    node exporter never reads a partially written file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.parent / f".{path.name}.tmp"
+    tmp_path.write_text(content)
+    os.replace(tmp_path, path)
+
+
+def _file_size(path: Path) -> int:
+    # SQLite keeps recent writes in the write-ahead log.
+    size = 0
+    for file in [path, path.with_name(path.name + "-wal")]:
+        if file.exists():
+            size += file.stat().st_size
+    return size
+
+
+def _count_unsent_messages(path: Path) -> int:
+    # Read directly, as the message store loads every unsent message.
+    if not path.exists():
+        return 0
+
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        (count,) = connection.execute(
+            "SELECT COUNT(*) FROM message WHERE NOT EXISTS ("
+            "SELECT 1 FROM response WHERE response.message_id = message.id "
+            "AND response.status = 0)"
+        ).fetchone()
+    finally:
+        connection.close()
+    return count
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def generate_metrics_task(
+    metrics_store: MetricsStore,
+    textfile: Path,
+    tmp_audio: Path,
+    db_metadata: Path,
+    messages_db: Path,
+    logger: logging.Logger = logger,
+) -> Callable[[], None]:
+    """Generate a task that writes the program metrics.
+
+    Parameters
+    ----------
+    metrics_store : MetricsStore
+        The store with the accumulated task metrics.
+    textfile : Path
+        Path of the Prometheus text file to write.
+    tmp_audio : Path
+        Directory of the recordings waiting to be processed.
+    db_metadata : Path
+        Path of the metadata store.
+    messages_db : Path
+        Path of the message store, to count the unsent messages.
+    logger : logging.Logger, optional
+        The logger to log messages, by default logger.
+    """
+
+    def metrics_task() -> None:
+        """Write the program metrics to the metrics text file."""
+        gauges = {
+            "pending_temp_files": (
+                "Recordings in the temporary directory.",
+                len(get_temp_files(tmp_audio)),
+            ),
+            "store_size_bytes": (
+                "Size of the metadata store in bytes.",
+                _file_size(db_metadata),
+            ),
+            "unsent_messages": (
+                "Messages waiting to be sent.",
+                _count_unsent_messages(messages_db),
+            ),
+        }
+
+        # Worker processes are replaced when they exit, for instance after
+        # a maximum number of tasks.
+        worker_memory = metrics_store.get_worker_memory()
+        exited = [
+            memory.pid
+            for memory in worker_memory
+            if not _is_running(memory.pid)
+        ]
+        if exited:
+            metrics_store.remove_worker_memory(exited)
+            worker_memory = [
+                memory for memory in worker_memory if memory.pid not in exited
+            ]
+
+        content = render_metrics(
+            metrics_store.get_task_metrics(),
+            gauges,
+            buckets=metrics_store.buckets,
+            worker_memory=worker_memory,
+        )
+        write_textfile(textfile, content)
+        logger.debug("Metrics written to %s", textfile)
+
+    return metrics_task
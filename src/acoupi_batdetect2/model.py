@@ -1,6 +1,10 @@
 """Acoupi detection and classification Models."""
 
 import logging
+import math
+import queue
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from acoupi import data
 from acoupi.components import types
@@ -8,6 +12,10 @@ from acoupi.components import types
 # Set the logging level of the numba library to WARNING for easier debugging
 logging.getLogger("numba").setLevel(logging.WARNING)
 
+# Seconds between checks for a stopped pipeline while the prefetch queue
+# is full.
+PIPELINE_POLL_INTERVAL = 0.1
+
 
 class BatDetect2(types.Model):
     """BatDetect2 Model to analyse the audio recording.
@@ -15,17 +23,81 @@ class BatDetect2(types.Model):
     This model uses the BatDetect2 library to detect bat calls in audio
     recordings and classify them into one of the 18 UK bat species.
 
+    The model can optionally run as a two-pass cascade. The spectrogram
+    of the full recording is computed once and used to find the time windows
+    with acoustic activity. Only these windows are cropped and run through
+    the detection and classification network, and the detections are then
+    re-mapped to recording time. As bat calls usually occupy a small fraction
+    of each recording, this avoids running the network on silence.
+
+    The network attends over the whole width of its input, so the scores of
+    the detections in a cropped window differ slightly from those of the
+    full run, and more so the less context the window has. With less than
+    about 50 ms of context, detections are lost and spurious ones appear at
+    the window edges. Recordings where most frames are active, such as a
+    continuous bat pass, are run in full: cropping them saves little time.
+
+    Multi-channel recordings are decoded once and every channel is
+    analysed. A call heard on several channels is returned as a single
+    detection, with the boxes and scores of the channel where it was
+    detected with the highest probability, and one `channel` tag for each
+    channel it was heard on. The program only counts the `species` tags in
+    its summaries and messages. Up to `channel_batch_size` channels are
+    stacked into a single batch and run through the network in one forward
+    pass; by default every channel is run on its own.
+
+    Several recordings can be processed as a pipeline with `run_pipelined`.
+    A background thread decodes the next recordings and computes their
+    spectrograms while the network processes the current one.
+
     Attributes
     ----------
     name : str
         The name of the model, by default "BatDetect2".
+    cascade : bool
+        Whether to run the model as a two-pass cascade, by default False.
+    activity_threshold : float
+        Number of standard deviations above the median spectrogram activity
+        for a time frame to be considered active in the cascade first pass.
+    context : float
+        Duration (in seconds) of context added on each side of the active
+        time windows before running the network, by default 0.05.
+    max_active_fraction : float
+        If the active windows cover more than this fraction of the
+        recording, the network is run on the full spectrogram instead, by
+        default 0.5.
+    fast_spectrogram : bool
+        Whether to compute spectrograms with the preallocated
+        `FastSpectrogram` pipeline instead of the library function, by
+        default False.
+    channel_batch_size : int, optional
+        Maximum number of channels run through the network in one forward
+        pass, by default 1. If None, all channels are run at once. On a
+        single CPU core a batched pass is slower than one pass per channel,
+        as its activations are larger.
     """
 
     name: str = "BatDetect2"
 
-    def __init__(self):
+    def __init__(
+        self,
+        cascade: bool = False,
+        activity_threshold: float = 3.0,
+        context: float = 0.05,
+        max_active_fraction: float = 0.5,
+        fast_spectrogram: bool = False,
+        channel_batch_size: Optional[int] = 1,
+    ):
         """Initialise the BatDetect2 model."""
         self._api = None
+        self._local = threading.local()
+        self._resampler = None
+        self.cascade = cascade
+        self.activity_threshold = activity_threshold
+        self.context = context
+        self.max_active_fraction = max_active_fraction
+        self.fast_spectrogram = fast_spectrogram
+        self.channel_batch_size = channel_batch_size
 
     @property
     def api(self):
@@ -40,6 +112,85 @@ class BatDetect2(types.Model):
 
         self._api = api
 
+    @property
+    def spectrogram(self):
+        # The buffers are overwritten by every call, so each thread has its
+        # own fast spectrogram.
+        spectrogram = getattr(self._local, "spectrogram", None)
+        if spectrogram is None:
+            from acoupi_batdetect2.spectrogram import FastSpectrogram
+
+            spectrogram = FastSpectrogram()
+            self._local.spectrogram = spectrogram
+
+        return spectrogram
+
+    @property
+    def resampler(self):
+        if self._resampler is None:
+            from acoupi_batdetect2.resampling import PolyphaseResampler
+
+            self._resampler = PolyphaseResampler()
+
+        return self._resampler
+
+    def load_audio(self, path: str):
+        """Load every channel of an audio file.
+
+        The file is decoded once and all channels are resampled together
+        to the sample rate expected by the network. Recordings made at
+        that sample rate are not resampled.
+
+        Returns
+        -------
+        np.ndarray
+            The audio, with shape (channels, samples).
+        """
+        import numpy as np
+        import soundfile as sf
+
+        audio, samplerate = sf.read(path, dtype="float32", always_2d=True)
+        audio = np.ascontiguousarray(audio.T)
+
+        target_samplerate = self.api.CONFIG["target_samp_rate"]  # type: ignore
+        return self.resampler(audio, samplerate, target_samplerate)
+
+    def generate_spectrogram(self, audio):
+        """Compute the spectrogram that is fed to the network."""
+        if not self.fast_spectrogram:
+            return self.api.generate_spectrogram(audio)  # type: ignore
+
+        spec = self.spectrogram(audio)
+        return spec.to(self.api.DEVICE)  # type: ignore
+
+    def generate_spectrograms(self, audio):
+        """Compute the spectrograms of all channels as a single batch.
+
+        Parameters
+        ----------
+        audio : np.ndarray
+            The audio, with shape (channels, samples).
+
+        Returns
+        -------
+        torch.Tensor
+            The spectrograms, with shape (channels, 1, height, width).
+        """
+        import torch
+
+        if audio.shape[0] == 1:
+            return self.generate_spectrogram(audio[0])
+
+        # The fast spectrogram buffer is overwritten by the next channel.
+        return torch.cat(
+            [
+                self.generate_spectrogram(channel).clone()
+                if self.fast_spectrogram
+                else self.generate_spectrogram(channel)
+                for channel in audio
+            ]
+        )
+
     def run(self, recording: data.Recording) -> data.ModelOutput:
         """Run the model on the recording.
 
@@ -53,43 +204,156 @@ class BatDetect2(types.Model):
         data.ModelOutput
             The model output containing the detections.
         """
-        # Get the audio path of the recorded file
-        audio_file_path = recording.path
+        return self.process(recording, self.prepare(recording))
 
-        if not audio_file_path:
+    def run_pipelined(
+        self,
+        recordings: Iterable[data.Recording],
+        prefetch: int = 2,
+    ) -> Iterator[data.ModelOutput]:
+        """Run the model on several recordings, overlapping their loading.
+
+        A background thread decodes the recordings and computes their
+        spectrograms, at most `prefetch` recordings ahead of the network.
+        The model outputs are yielded in the order of the recordings, as
+        soon as each one is ready.
+
+        Parameters
+        ----------
+        recordings : Iterable[data.Recording]
+            The audio recordings to process.
+        prefetch : int
+            Maximum number of recordings loaded ahead of the network.
+
+        Yields
+        ------
+        data.ModelOutput
+            The model output of each recording.
+
+        Raises
+        ------
+        Exception
+            Any error raised while loading or processing a recording is
+            raised when its turn comes, and the pipeline is stopped.
+        """
+        pending: queue.Queue = queue.Queue(maxsize=max(prefetch, 1))
+        stopped = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce() -> None:
+            try:
+                for recording in recordings:
+                    try:
+                        item = (recording, self._prefetch(recording), None)
+                    except Exception as error:
+                        item = (recording, None, error)
+
+                    if not put(item) or item[2] is not None:
+                        return
+            finally:
+                put(done)
+
+        producer = threading.Thread(
+            target=produce,
+            name="batdetect2-prefetch",
+            daemon=True,
+        )
+        producer.start()
+
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    return
+
+                recording, spec, error = item
+                if error is not None:
+                    raise error
+
+                yield self.process(recording, spec)
+        finally:
+            stopped.set()
+            producer.join()
+
+    def prepare(self, recording: data.Recording):
+        """Load the recording and compute the spectrograms of its channels.
+
+        Returns
+        -------
+        torch.Tensor, optional
+            The spectrograms, with shape (channels, 1, height, width), or
+            None if the recording has no audio file.
+        """
+        if not recording.path:
+            return None
+
+        audio = self.load_audio(str(recording.path))
+        return self.generate_spectrograms(audio)
+
+    def _prefetch(self, recording: data.Recording):
+        spec = self.prepare(recording)
+
+        # The fast spectrogram buffer is overwritten by the next recording.
+        if spec is not None and self.fast_spectrogram:
+            spec = spec.clone()
+
+        return spec
+
+    def process(
+        self,
+        recording: data.Recording,
+        spec,
+    ) -> data.ModelOutput:
+        """Run the network on the spectrograms of a recording.
+
+        Parameters
+        ----------
+        recording : data.Recording
+            The audio recording.
+        spec : torch.Tensor, optional
+            The spectrograms of the recording, as returned by `prepare`.
+
+        Returns
+        -------
+        data.ModelOutput
+            The model output containing the detections.
+        """
+        if spec is None:
             return data.ModelOutput(
                 name_model="BatDetect2",
                 recording=recording,
             )
 
-        # Load the audio file and compute spectrograms
-        audio = self.api.load_audio(str(audio_file_path))  # type: ignore
-        spec = self.api.generate_spectrogram(audio)  # type: ignore
-
-        # Process the audio or the spectrogram with the model
-        raw_detections, _ = self.api.process_spectrogram(spec)  # type: ignore
+        # Process the spectrograms with the model
+        if self.cascade:
+            channel_detections = [
+                self._process_active_windows(spec[channel : channel + 1])
+                for channel in range(spec.shape[0])
+            ]
+        else:
+            batch_size = self.channel_batch_size or spec.shape[0]
+            channel_detections = []
+            for start in range(0, spec.shape[0], batch_size):
+                channel_detections.extend(
+                    self._process_batch(spec[start : start + batch_size])
+                )
 
         # Convert the raw detections to a list of detections
         detections = [
-            data.Detection(
-                detection_score=detection["det_prob"],
-                location=data.BoundingBox.from_coordinates(
-                    detection["start_time"],
-                    detection["low_freq"],
-                    detection["end_time"],
-                    detection["high_freq"],
-                ),
-                tags=[
-                    data.PredictedTag(
-                        tag=data.Tag(
-                            key="species",
-                            value=detection["class"],
-                        ),
-                        confidence_score=detection["class_prob"],
-                    ),
-                ],
+            self._to_detection(
+                detection,
+                channels if len(channel_detections) > 1 else [],
             )
-            for detection in raw_detections
+            for detection, channels in self._merge_channels(channel_detections)
         ]
 
         return data.ModelOutput(
@@ -97,3 +361,240 @@ class BatDetect2(types.Model):
             recording=recording,
             detections=detections,
         )
+
+    def _merge_channels(
+        self,
+        channel_detections: List[List[dict]],
+    ) -> List[Tuple[dict, List[int]]]:
+        """Merge the detections of the same call on different channels.
+
+        Detections of the same class on different channels whose boxes
+        overlap in time and frequency are considered to be the same call.
+
+        Returns
+        -------
+        List[Tuple[dict, List[int]]]
+            The raw detection with the highest detection probability of
+            each call, and the channels the call was heard on.
+        """
+        merged: List[Tuple[dict, List[int]]] = []
+        for channel, raw_detections in enumerate(channel_detections):
+            for detection in raw_detections:
+                for index, (other, channels) in enumerate(merged):
+                    if channel in channels or not _same_call(detection, other):
+                        continue
+
+                    if detection["det_prob"] > other["det_prob"]:
+                        other = detection
+
+                    merged[index] = (other, [*channels, channel])
+                    break
+                else:
+                    merged.append((detection, [channel]))
+
+        return merged
+
+    def _to_detection(
+        self,
+        detection: dict,
+        channels: Iterable[int] = (),
+    ) -> data.Detection:
+        """Convert a raw BatDetect2 detection to a detection."""
+        tags = [
+            data.PredictedTag(
+                tag=data.Tag(
+                    key="species",
+                    value=detection["class"],
+                ),
+                confidence_score=detection["class_prob"],
+            ),
+            *[
+                data.PredictedTag(
+                    tag=data.Tag(key="channel", value=str(channel)),
+                )
+                for channel in channels
+            ],
+        ]
+
+        return data.Detection(
+            detection_score=detection["det_prob"],
+            location=data.BoundingBox.from_coordinates(
+                detection["start_time"],
+                detection["low_freq"],
+                detection["end_time"],
+                detection["high_freq"],
+            ),
+            tags=tags,
+        )
+
+    def _process_batch(self, spec) -> List[List[dict]]:
+        """Run the network on a batch of spectrograms in one forward pass.
+
+        Equivalent to calling `api.process_spectrogram` on each spectrogram
+        of the batch, which is done for a batch of a single spectrogram.
+
+        Parameters
+        ----------
+        spec : torch.Tensor
+            The spectrograms, with shape (batch, 1, height, width).
+
+        Returns
+        -------
+        List[List[dict]]
+            The raw detections of each spectrogram.
+        """
+        if spec.shape[0] == 1:
+            raw_detections, _ = self.api.process_spectrogram(spec)  # type: ignore
+            return [raw_detections]
+
+        import numpy as np
+        import torch
+        from batdetect2.detector import post_process as pp
+        from batdetect2.utils import detector_utils as du
+
+        config = self.api.CONFIG  # type: ignore
+        with torch.no_grad():
+            outputs = self.api.MODEL(spec)  # type: ignore
+
+        predictions, _ = pp.run_nms(
+            outputs,
+            {
+                "nms_kernel_size": config["nms_kernel_size"],
+                "max_freq": config["max_freq"],
+                "min_freq": config["min_freq"],
+                "fft_win_length": config["fft_win_length"],
+                "fft_overlap": config["fft_overlap"],
+                "resize_factor": config["resize_factor"],
+                "nms_top_k_per_sec": config["nms_top_k_per_sec"],
+                "detection_threshold": config["detection_threshold"],
+            },
+            np.full(spec.shape[0], float(config["target_samp_rate"])),
+        )
+
+        num_classes = len(config["class_names"])
+        raw_detections = []
+        for prediction in predictions:
+            # Drop the background class
+            class_probs = prediction.get("class_probs")
+            if class_probs is not None and class_probs.shape[0] > num_classes:
+                prediction["class_probs"] = class_probs[:-1, :]
+
+            raw_detections.append(
+                du.get_annotations_from_preds(
+                    prediction,
+                    config["class_names"],
+                )
+            )
+
+        return raw_detections
+
+    def _process_active_windows(self, spec) -> List[dict]:
+        """Run the network only on the active windows of the spectrogram.
+
+        Parameters
+        ----------
+        spec : torch.Tensor
+            The full spectrogram of the recording, as returned by
+            `api.generate_spectrogram`.
+
+        Returns
+        -------
+        List[dict]
+            The raw detections, with times relative to the recording start.
+        """
+        width = spec.shape[-1]
+        windows = self._find_active_windows(spec)
+
+        active = sum(end - start for start, end in windows)
+        if active > self.max_active_fraction * width:
+            raw_detections, _ = self.api.process_spectrogram(spec)  # type: ignore
+            return raw_detections
+
+        column_duration = self._column_duration()
+        raw_detections = []
+        for start, end in windows:
+            window_detections, _ = self.api.process_spectrogram(  # type: ignore
+                spec[..., start:end]
+            )
+
+            offset = start * column_duration
+            for detection in window_detections:
+                detection["start_time"] = round(
+                    detection["start_time"] + offset, 4
+                )
+                detection["end_time"] = round(
+                    detection["end_time"] + offset, 4
+                )
+                raw_detections.append(detection)
+
+        return raw_detections
+
+    def _find_active_windows(self, spec) -> List[Tuple[int, int]]:
+        """Find the spectrogram time windows that contain activity.
+
+        A time frame is active if its maximum value across frequencies is
+        more than `activity_threshold` standard deviations above the median.
+        Windows are aligned to the network's downsampling factor so that
+        they can be processed without padding.
+
+        Returns
+        -------
+        List[Tuple[int, int]]
+            The start and end columns of each active window.
+        """
+        config = self.api.CONFIG  # type: ignore
+        block = config["spec_divide_factor"]
+        width = spec.shape[-1]
+
+        activity = spec[0, 0].amax(dim=0)
+        threshold = (
+            activity.median() + self.activity_threshold * activity.std()
+        )
+        active_columns = (activity > threshold).nonzero().flatten().tolist()
+
+        if not active_columns:
+            return []
+
+        # Number of context blocks added on each side of an active block.
+        context_columns = self.context / self._column_duration()
+        context_blocks = math.ceil(context_columns / block)
+
+        num_blocks = math.ceil(width / block)
+        active_blocks = set()
+        for column in active_columns:
+            index = column // block
+            active_blocks.update(
+                range(
+                    max(index - context_blocks, 0),
+                    min(index + context_blocks + 1, num_blocks),
+                )
+            )
+
+        windows: List[Tuple[int, int]] = []
+        for index in sorted(active_blocks):
+            if windows and windows[-1][1] == index * block:
+                windows[-1] = (windows[-1][0], (index + 1) * block)
+                continue
+
+            windows.append((index * block, (index + 1) * block))
+
+        return [(start, min(end, width)) for start, end in windows]
+
+    def _column_duration(self) -> float:
+        """Duration (in seconds) of a single column of the network input."""
+        config = self.api.CONFIG  # type: ignore
+        samplerate = config["target_samp_rate"]
+        nfft = int(config["fft_win_length"] * samplerate)
+        hop = nfft - int(config["fft_overlap"] * nfft)
+        return hop / (config["resize_factor"] * samplerate)
+
+
+def _same_call(detection: dict, other: dict) -> bool:
+    """Check if two raw detections are of the same call."""
+    return (
+        detection["class"] == other["class"]
+        and detection["start_time"] <= other["end_time"]
+        and other["start_time"] <= detection["end_time"]
+        and detection["low_freq"] <= other["high_freq"]
+        and other["low_freq"] <= detection["high_freq"]
+    )
@@ -21,17 +21,64 @@ will either saved or deleted.
 the detections, and can use a custom `ModelOutputCleaner` to filter out unwanted
 detections (e.g., low-confidence results). The filtered detections are saved in
 a `metadata.db` file.
+- __detection_backlog_task__: Periodically runs the BatDetect2 model on the
+recordings that have waited too long for their detection, loading the next
+recordings in the background while the model runs.
 - __management_task__: Performs periodically file management operations,
 such as moving recording to permanent storage, or deleting unnecessary ones.
 - __messaging_task__: Send messages stored in the message store using a
 configured protocol (HTTP or MQTT).
 - __summary_task__: Periodically creates summaries of the detections.
+- __metrics_task__: Periodically writes the program metrics to a Prometheus
+text file.
+- __maintenance_task__: Outside of the recording schedule, indexes, prunes
+and compacts the metadata and message stores.
+- __compression_task__: Losslessly compresses the saved recordings to FLAC.
+
+### Task Queues:
+
+Each task type is routed to its own queue, consumed by a dedicated worker,
+so that a slow detection or summary run never delays the next recording:
+
+- __recording__: `recording_task`, single worker with a concurrency of 1.
+- __detection__: `detection_task`, `detection_backlog_task` and
+`final_detection_task`, run the CPU-heavy model inference.
+- __management__: `file_management_task`, `metrics_task` and
+`maintenance_task`.
+- __summary__: `summary_task`.
+- __compression__: `compression_task`, single low priority worker.
+- __celery__: messaging and heartbeat tasks.
+
+The concurrency of the detection, management, summary and default workers
+can be set with the `BatDetect2_WorkerSettings` environment variables.
+
+### Detection Queries:
+
+The detections in the metadata store are indexed by time, frequency and
+species with an SQLite R*Tree, updated as each model output is stored.
+`program.detection_index.query(...)` returns the detections overlapping a
+time window and frequency band, e.g. all detections between 40 and 60 kHz
+in the last week. The detections stored before the index was created are
+indexed when the program starts.
 
 ### Customisation Options:
 
 - __ModelConfig__: Set the `detection_threshold` to clean out the output of the
 BatDetect2 model. Detections with a confidence score below this threshold
-will be excluded from the store and from the message content.
+will be excluded from the store and from the message content. Set `cascade`
+to only run the model on the time windows of a recording with acoustic
+activity; recordings whose active frames cover more than
+`cascade_max_active_fraction` of their duration are run in full. Every
+channel of multi-channel recordings is analysed, and `channel_batch_size`
+limits how many channels are run through the model at once, one by
+default. A call heard on several channels is stored once, with a `channel`
+tag for each of them, and the summaries and messages only count its
+species. Every `backlog_interval` seconds, and when the program ends, the
+recordings that are still waiting for detection are processed as a
+pipeline: up to `prefetch` recordings are decoded ahead of the model in a
+background thread. Set `preload` to load the model in the parent process
+of the detection worker before its pool processes are forked, so that they
+share a single copy of the weights instead of loading one each.
 
 - __SaveRecordingManager__: Define where recordings are stored, the naming format, and
 the minimum confidence score for saving recordings. Recordings with confidence
@@ -52,8 +99,8 @@ the `false_dir` directory.
      (in minutes) before dawn and dusk, set by the `before_dawndusk_duration`.
     4. An after dawn/dusk filter to save recording for a defined duration
      (in minutes) after dawn and dusk, set by the `after_dawndusk_duration`.
-    5. A saving threshold filter to save recording with detection above a specific 
-    treshold, set by the `saving_filter` parameter. 
+    5. A saving threshold filter to save recording with detection above a specific
+    treshold, set by the `saving_filter` parameter.
 
 - __SummariserConfig__: Define the interval for summarising detections.
 By default, the summariser calculates the minimum, maximum, and average
@@ -61,19 +108,142 @@ confidence scores of the total number of detections for each time interval.
 If the `low_band_threshold`, `mid_band_threshold`, and `high_band_threshold` are
 set to values greater than 0.0, it also summarises the number of detections in
 each band (low, mid, high).
+
+- __BatDetect2_PathsConfig__: Set `cache` to the directory where the
+functions compiled by numba, for `librosa` and the fast spectrogram
+pipeline, are kept across restarts. The cache is keyed by the library
+versions and the model checkpoint, so it is rebuilt after an upgrade.
+
+- __MetricsConfig__: Define where the operational metrics are written. The
+number of runs, failures and queued runs, and a histogram of the run time of
+each task, together with the number of pending temporary recordings, the size
+of the metadata store, the number of unsent messages and the memory used by
+each worker process (rss, pss and shared), are written every
+`interval` seconds to `textfile` in the Prometheus text format, ready to be
+scraped by the node exporter textfile collector. Set `metrics` to None to
+disable them.
+
+- __MaintenanceConfig__: Define how the metadata and message stores are kept
+small and fast. Every `interval` minutes outside of the recording schedule,
+the maintenance task creates the indexes used by the summariser and message
+queries, prunes the recordings, detections and sent messages older than
+`retention_days` (archiving them to `archive_path` if set), and runs an
+incremental VACUUM and ANALYZE. The incremental VACUUM only releases free
+pages once `convert_auto_vacuum` has switched the stores to incremental
+auto vacuum, with a one-off full VACUUM. Set `maintenance` to None to
+disable it.
+
+- __CompressionConfig__: Compress the saved recordings to FLAC in the
+background. Every `interval` seconds, up to `max_files` WAV files saved
+at least `min_age` seconds ago are encoded, verified against the original
+samples, and then replace the WAV file in storage and in the metadata
+store. The worker runs with a raised `niceness` so that it does not slow
+down recording and detection. Disabled by default.
 """
 
 import datetime
+from typing import Optional
 
 import pytz
 from acoupi import components, data, tasks
 from acoupi.components import types
+from acoupi.programs import AcoupiWorker, WorkerConfig
 from acoupi.programs.templates import DetectionProgram
 
+from acoupi_batdetect2.cache import CompileCache
+from acoupi_batdetect2.compression import (
+    FlacEncoder,
+    generate_compression_task,
+)
 from acoupi_batdetect2.configuration import (
     BatDetect2_ConfigSchema,
+    BatDetect2_WorkerSettings,
+)
+from acoupi_batdetect2.detection import (
+    UnprocessedRecordingFilter,
+    generate_pipelined_detection_task,
+)
+from acoupi_batdetect2.index import DetectionIndex
+from acoupi_batdetect2.maintenance import (
+    MessageStoreMaintainer,
+    MetadataStoreMaintainer,
+    generate_maintenance_task,
+)
+from acoupi_batdetect2.metrics import (
+    MetricsStore,
+    TaskMetricsRecorder,
+    generate_metrics_task,
 )
 from acoupi_batdetect2.model import BatDetect2
+from acoupi_batdetect2.sharing import ModelPreloader
+from acoupi_batdetect2.species import (
+    SpeciesTagStore,
+    SpeciesThresholdMessageBuilder,
+)
+
+RECORDING_QUEUE = "recording"
+DETECTION_QUEUE = "detection"
+MANAGEMENT_QUEUE = "management"
+SUMMARY_QUEUE = "summary"
+COMPRESSION_QUEUE = "compression"
+DEFAULT_QUEUE = "celery"
+
+
+def get_worker_config(
+    settings: Optional[BatDetect2_WorkerSettings] = None,
+) -> WorkerConfig:
+    """Get the worker configuration for the BatDetect2 Program.
+
+    Parameters
+    ----------
+    settings : BatDetect2_WorkerSettings, optional
+        The worker concurrency settings. If None, the settings are read
+        from the environment.
+
+    Returns
+    -------
+    WorkerConfig
+        One worker per task queue. The recording and compression workers
+        have a concurrency of 1 so that audio capture is never blocked by
+        other tasks, and compression never takes more than one core.
+    """
+    if settings is None:
+        settings = BatDetect2_WorkerSettings()
+
+    return WorkerConfig(
+        workers=[
+            AcoupiWorker(
+                name="recording",
+                queues=[RECORDING_QUEUE],
+                concurrency=1,
+            ),
+            AcoupiWorker(
+                name="detection",
+                queues=[DETECTION_QUEUE],
+                concurrency=settings.detection_concurrency,
+            ),
+            AcoupiWorker(
+                name="management",
+                queues=[MANAGEMENT_QUEUE],
+                concurrency=settings.management_concurrency,
+            ),
+            AcoupiWorker(
+                name="summary",
+                queues=[SUMMARY_QUEUE],
+                concurrency=settings.summary_concurrency,
+            ),
+            AcoupiWorker(
+                name="compression",
+                queues=[COMPRESSION_QUEUE],
+                concurrency=1,
+            ),
+            AcoupiWorker(
+                name="default",
+                queues=[DEFAULT_QUEUE],
+                concurrency=settings.default_concurrency,
+            ),
+        ]
+    )
 
 
 class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
@@ -81,6 +251,8 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
 
     config_schema = BatDetect2_ConfigSchema
 
+    worker_config = get_worker_config()
+
     def setup(self, config):
         """Set up the BatDetect2 Program.
 
@@ -88,9 +260,55 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
         recording, detection, management, messaging, and summariser tasks,
         and performs any necessary setup for the program to run.
         """
+        # Keep the compiled functions across restarts. Must happen before
+        # the model libraries are imported.
+        self.compile_cache = CompileCache(config.paths.cache)
+        self.compile_cache.activate()
+
         # Setup all the elements from the DetectionProgram
         super().setup(config)
 
+        # Share one copy of the model weights between the detection
+        # worker processes.
+        if config.model.preload:
+            self.model_preloader = ModelPreloader(
+                self.model,
+                [DETECTION_QUEUE],
+                logger=self.logger.getChild("preload"),
+            )
+            self.model_preloader.connect()
+
+        # Index the detections for time and frequency range queries. The
+        # detections stored before the index are indexed on start.
+        self.detection_index = DetectionIndex(config.paths.db_metadata)
+        self.detection_index.create()
+
+        # Process the recordings waiting for detection as a pipeline,
+        # periodically and when the program ends.
+        if config.model.backlog_interval:
+            self.add_task(
+                function=self.create_detection_backlog_task(
+                    config,
+                    min_age=config.model.backlog_interval,
+                ),
+                schedule=datetime.timedelta(
+                    seconds=config.model.backlog_interval
+                ),
+                queue=DETECTION_QUEUE,
+            )
+
+        self.add_task(
+            function=self.create_detection_backlog_task(config),
+            queue=DETECTION_QUEUE,
+            name="final_detection_task",
+        )
+
+        # Route the detection and management tasks away from the default
+        # queue so that inference and file operations run on their own
+        # workers.
+        self.add_task_to_queue("detection_task", DETECTION_QUEUE)
+        self.add_task_to_queue("file_management_task", MANAGEMENT_QUEUE)
+
         # Create the summariser task
         if config.summariser_config and config.summariser_config.interval:
             summary_task = tasks.generate_summariser_task(
@@ -104,8 +322,102 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
                 schedule=datetime.timedelta(
                     minutes=config.summariser_config.interval
                 ),
+                queue=SUMMARY_QUEUE,
             )
 
+        # Create the metrics task
+        if config.metrics:
+            self.metrics_store = MetricsStore(config.metrics.db_path)
+
+            # Record the metrics of every program task run by this process.
+            self.metrics_recorder = TaskMetricsRecorder(
+                self.metrics_store,
+                self.tasks,
+            )
+            self.metrics_recorder.connect()
+
+            metrics_task = generate_metrics_task(
+                metrics_store=self.metrics_store,
+                textfile=config.metrics.textfile,
+                tmp_audio=config.paths.tmp_audio,
+                db_metadata=config.paths.db_metadata,
+                messages_db=config.messaging.messages_db,
+                logger=self.logger.getChild("metrics"),
+            )
+
+            self.add_task(
+                function=metrics_task,
+                schedule=datetime.timedelta(seconds=config.metrics.interval),
+                queue=MANAGEMENT_QUEUE,
+            )
+
+        # Create the store maintenance task
+        if config.maintenance:
+            self.add_task(
+                function=self.create_maintenance_task(config),
+                schedule=datetime.timedelta(
+                    minutes=config.maintenance.interval
+                ),
+                queue=MANAGEMENT_QUEUE,
+            )
+
+        # Create the recording compression task
+        if config.compression:
+            compression_task = generate_compression_task(
+                directories=[
+                    config.paths.recordings / config.saving_managers.true_dir,
+                    config.paths.recordings / config.saving_managers.false_dir,
+                ],
+                store=self.store,
+                encoder=FlacEncoder(),
+                max_files=config.compression.max_files,
+                min_age=config.compression.min_age,
+                niceness=config.compression.niceness,
+                logger=self.logger.getChild("compression"),
+            )
+
+            self.add_task(
+                function=compression_task,
+                schedule=datetime.timedelta(
+                    seconds=config.compression.interval
+                ),
+                queue=COMPRESSION_QUEUE,
+            )
+
+    def on_start(self, deployment: data.Deployment) -> None:
+        """Handle the program start event.
+
+        Starts the deployment as the `DetectionProgram` does, and indexes
+        the detections stored before the detection index was created.
+        """
+        super().on_start(deployment)
+        self.detection_index.index_stored()
+
+    def on_end(self, deployment: data.Deployment) -> None:
+        """Handle the program end event.
+
+        Completes the remaining tasks as the `DetectionProgram` does, but
+        the recordings left in the temporary directory are processed
+        together by the pipelined `final_detection_task` instead of one
+        detection task at a time.
+        """
+        # Skip the DetectionProgram, which runs the detection task on each
+        # remaining recording.
+        super(DetectionProgram, self).on_end(deployment)
+
+        if not any(self.config.paths.tmp_audio.glob("*")):
+            return
+
+        self.logger.info("Running detection on the remaining recordings.")
+        self.tasks["final_detection_task"].apply()
+
+        self.tasks["file_management_task"].apply()
+
+        if self.messenger is None:
+            return
+
+        self.tasks["send_messages_task"].apply()
+
     def configure_model(self, config):
         """Configure the BatDetect2 model.
 
@@ -114,7 +426,104 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
         BatDetect2
             The BatDetect2 model instance.
         """
-        return BatDetect2()
+        return BatDetect2(
+            cascade=config.model.cascade,
+            activity_threshold=config.model.cascade_activity_threshold,
+            context=config.model.cascade_context,
+            max_active_fraction=config.model.cascade_max_active_fraction,
+            fast_spectrogram=config.model.fast_spectrogram,
+            channel_batch_size=config.model.channel_batch_size,
+        )
+
+    def create_detection_backlog_task(self, config, min_age: float = 0):
+        """Create the pipelined detection task for a backlog of recordings.
+
+        Parameters
+        ----------
+        config : BatDetect2_ConfigSchema
+            The configuration schema for the _acoupi_batdetect2_ program defined in
+            the configuration.py file and configured by a user via the CLI.
+        min_age : float
+            Minimum age (in seconds) of the recordings to process.
+
+        Returns
+        -------
+        Callable[[], None]
+            The task. It runs the same steps as the detection task on every
+            recording of the temporary directory that has waited longer than
+            `min_age` without a model output, while the next recordings are
+            loaded in the background.
+        """
+        return generate_pipelined_detection_task(
+            store=self.store,
+            model=self.model,  # type: ignore
+            message_store=self.message_store,
+            tmp_audio=config.paths.tmp_audio,
+            logger=self.logger.getChild("detection"),
+            output_cleaners=self.get_output_cleaners(config),
+            processing_filters=self.get_processing_filters(config),
+            message_factories=self.get_message_factories(config),
+            prefetch=config.model.prefetch,
+            min_age=min_age,
+        )
+
+    def get_processing_filters(self, config) -> list[types.ProcessingFilter]:
+        """Get the processing filters for the BatDetect2 Program.
+
+        Parameters
+        ----------
+        config : BatDetect2_ConfigSchema
+            The configuration schema for the _acoupi_batdetect2_ program defined in
+            the configuration.py file and configured by a user via the CLI.
+
+        Returns
+        -------
+        list[types.ProcessingFilter]
+            The processing filters of the `DetectionProgram`, and a filter
+            that skips the recordings already processed by the
+            `detection_backlog_task`.
+        """
+        return [
+            *super().get_processing_filters(config),
+            UnprocessedRecordingFilter(self.store),
+        ]
+
+    def create_maintenance_task(self, config):
+        """Create the store maintenance task.
+
+        Parameters
+        ----------
+        config : BatDetect2_ConfigSchema
+            The configuration schema for the _acoupi_batdetect2_ program defined in
+            the configuration.py file and configured by a user via the CLI.
+
+        Returns
+        -------
+        Callable[[], None]
+            The maintenance task. It only runs when the program does not
+            record, that is when not all of its recording conditions hold.
+        """
+        maintenance = config.maintenance
+
+        retention = None
+        if maintenance.retention_days is not None:
+            retention = datetime.timedelta(days=maintenance.retention_days)
+
+        return generate_maintenance_task(
+            maintainers=[
+                MetadataStoreMaintainer(
+                    config.paths.db_metadata,
+                    archive_path=maintenance.archive_path,
+                    max_recordings=maintenance.max_pruned_recordings,
+                ),
+                MessageStoreMaintainer(config.messaging.messages_db),
+            ],
+            recording_conditions=self.get_recording_conditions(config),
+            retention=retention,
+            vacuum_pages=maintenance.vacuum_pages,
+            convert_auto_vacuum=maintenance.convert_auto_vacuum,
+            logger=self.logger.getChild("maintenance"),
+        )
 
     def get_summarisers(self, config) -> list[types.Summariser]:
         """Get the summarisers for the BatDetect2 Program.
@@ -140,10 +549,13 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
         summarisers = []
         summariser_config = config.summariser_config
 
+        # Only count the species tags, not the channel tags.
+        store = SpeciesTagStore(self.store)
+
         if summariser_config.interval != 0.0:
             summarisers.append(
                 components.StatisticsDetectionsSummariser(
-                    store=self.store,  # type: ignore
+                    store=store,  # type: ignore
                     interval=summariser_config.interval,
                 )
             )
@@ -156,7 +568,7 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
         ):
             summarisers.append(
                 components.ThresholdsDetectionsSummariser(
-                    store=self.store,  # type: ignore
+                    store=store,  # type: ignore
                     interval=summariser_config.interval,
                     low_band_threshold=summariser_config.low_band_threshold,
                     mid_band_threshold=summariser_config.mid_band_threshold,
@@ -210,7 +622,7 @@ class BatDetect2_Program(DetectionProgram[BatDetect2_ConfigSchema]):
             buildling messages.
         """
         return [
-            components.DetectionThresholdMessageBuilder(
+            SpeciesThresholdMessageBuilder(
                 detection_threshold=config.model.detection_threshold
             )
         ]
@@ -0,0 +1,108 @@
+"""Polyphase resampling of recordings to the BatDetect2 sample rate.
+
+The network expects audio at a fixed sample rate. Recordings made at a
+different rate are resampled with `scipy.signal.resample_poly`, as done by
+`librosa.resample` with `res_type="polyphase"`, but the anti-aliasing FIR
+filter is designed once per pair of sample rates and reused for every
+recording, instead of being designed again for each file.
+"""
+
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+from scipy import signal
+
+__all__ = [
+    "PolyphaseResampler",
+    "design_filter",
+]
+
+# Parameters of the anti-aliasing filter designed by
+# `scipy.signal.resample_poly`.
+FILTER_HALF_LENGTH = 10
+FILTER_WINDOW = ("kaiser", 5.0)
+
+
+class PolyphaseFilter(NamedTuple):
+    """Upsampling and downsampling factors with their FIR filter."""
+
+    up: int
+    down: int
+    window: np.ndarray
+
+
+@lru_cache(maxsize=4)
+def design_filter(orig_sr: int, target_sr: int) -> PolyphaseFilter:
+    """Design the polyphase filter between two sample rates.
+
+    The filter is the one designed by `scipy.signal.resample_poly`, in
+    single precision. The filters of the last few pairs of sample rates are
+    cached and shared by all resamplers.
+    """
+    gcd = np.gcd(orig_sr, target_sr)
+    up = target_sr // gcd
+    down = orig_sr // gcd
+    max_rate = max(up, down)
+    window = signal.firwin(
+        2 * FILTER_HALF_LENGTH * max_rate + 1,
+        1 / max_rate,
+        window=FILTER_WINDOW,
+    )
+    return PolyphaseFilter(
+        up=int(up),
+        down=int(down),
+        window=window.astype(np.float32),
+    )
+
+
+class PolyphaseResampler:
+    """Resample audio with cached polyphase filters.
+
+    Produces the same audio as `librosa.resample` with
+    `res_type="polyphase"` for `float32` input.
+    """
+
+    def __call__(
+        self,
+        audio: np.ndarray,
+        orig_sr: int,
+        target_sr: int,
+    ) -> np.ndarray:
+        """Resample the audio along its last axis.
+
+        Parameters
+        ----------
+        audio : np.ndarray
+            The audio, with shape (samples,) or (channels, samples).
+        orig_sr : int
+            The sample rate of the audio.
+        target_sr : int
+            The sample rate of the returned audio.
+
+        Returns
+        -------
+        np.ndarray
+            The resampled audio, with the same dtype as `audio`. If both
+            sample rates are equal the audio is returned unchanged.
+        """
+        if orig_sr == target_sr:
+            return audio
+
+        num_samples = int(np.ceil(audio.shape[-1] * target_sr / orig_sr))
+        up, down, window = design_filter(int(orig_sr), int(target_sr))
+        resampled = signal.resample_poly(
+            audio,
+            up,
+            down,
+            axis=-1,
+            window=window,
+        )
+
+        resampled = resampled[..., :num_samples]
+        missing = num_samples - resampled.shape[-1]
+        if missing > 0:
+            padding = [(0, 0)] * (resampled.ndim - 1) + [(0, missing)]
+            resampled = np.pad(resampled, padding)
+
+        return np.asarray(resampled, dtype=audio.dtype)
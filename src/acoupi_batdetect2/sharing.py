@@ -0,0 +1,106 @@
+"""Sharing of the BatDetect2 model across prefork worker processes.
+
+By default each Celery worker process imports `batdetect2` and loads its
+own copy of the model weights the first time it runs a detection. With
+several detection processes on a Raspberry Pi, the duplicated weights
+use a large share of the memory.
+
+The `ModelPreloader` loads the model in the parent process of the
+detection worker, before the pool processes are forked, so that every
+process uses the same copy of the weights:
+
+- The weights are moved to shared memory and marked as not requiring
+gradients, so they are never written to.
+- The objects created while loading the model are moved to the permanent
+generation of the garbage collector (`gc.freeze`), which then never
+touches them, so that their memory pages stay shared after the fork.
+
+The memory used by each worker process is reported by the metrics of the
+program, to verify the savings.
+"""
+
+import gc
+import logging
+from typing import Iterable, Set
+
+from celery import signals
+
+from acoupi_batdetect2.model import BatDetect2
+
+__all__ = [
+    "ModelPreloader",
+    "share_model_weights",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def share_model_weights(model: BatDetect2) -> int:
+    """Load the model and move its weights to shared memory.
+
+    Returns
+    -------
+    int
+        The size of the shared weights, in bytes.
+    """
+    network = model.api.MODEL  # type: ignore
+    network.eval()
+
+    size = 0
+    for parameter in network.parameters():
+        parameter.requires_grad_(False)
+
+    for tensor in [*network.parameters(), *network.buffers()]:
+        tensor.share_memory_()
+        size += tensor.numel() * tensor.element_size()
+
+    # Keep the garbage collector away from the objects created so far.
+    gc.collect()
+    gc.freeze()
+    return size
+
+
+class ModelPreloader:
+    """Load the model in the parent of the detection worker processes.
+
+    Attributes
+    ----------
+    model : BatDetect2
+        The model of the program.
+    queues : Set[str]
+        The model is only loaded by the workers consuming from one of these
+        queues, so that the other workers do not hold a copy.
+    """
+
+    def __init__(
+        self,
+        model: BatDetect2,
+        queues: Iterable[str],
+        logger: logging.Logger = logger,
+    ):
+        """Initialise the model preloader."""
+        self.model = model
+        self.queues: Set[str] = set(queues)
+        self.logger = logger
+
+    def connect(self) -> None:
+        """Load the model when a worker starts, before forking."""
+        signals.worker_init.connect(self.on_worker_init)
+
+    def disconnect(self) -> None:
+        """Stop loading the model when a worker starts."""
+        signals.worker_init.disconnect(self.on_worker_init)
+
+    def on_worker_init(self, sender=None, **kwargs) -> None:
+        if sender is None:
+            return
+
+        consumed = set(sender.app.amqp.queues.consume_from)
+        if not consumed & self.queues:
+            return
+
+        size = share_model_weights(self.model)
+        self.logger.info(
+            "Loaded the model before forking, sharing %.1f MB of weights",
+            size / 2**20,
+        )
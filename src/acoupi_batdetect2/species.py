@@ -0,0 +1,67 @@
+"""Species only views of the detections for summaries and messages.
+
+The detections of multi-channel recordings carry a `channel` tag for each
+channel the call was heard on, next to their `species` tag. The _acoupi_
+summarisers group every predicted tag of a detection by its value, so
+they would count the channel tags as species. The wrappers in this module
+restrict the summaries and messages to the `species` tags, while the
+channel tags are kept in the store.
+"""
+
+from typing import List
+
+from acoupi import data
+from acoupi.components import DetectionThresholdMessageBuilder, types
+
+__all__ = [
+    "SPECIES_KEY",
+    "SpeciesTagStore",
+    "SpeciesThresholdMessageBuilder",
+]
+
+SPECIES_KEY = "species"
+"""The key of the predicted tags holding the species of a detection."""
+
+
+class SpeciesTagStore:
+    """Store that only returns the species tags of the detections.
+
+    Every other method is delegated to the wrapped store.
+
+    Attributes
+    ----------
+    store : types.Store
+        The store of the program.
+    """
+
+    def __init__(self, store: types.Store):
+        """Initialise the species tag store."""
+        self.store = store
+
+    def get_predicted_tags(self, **kwargs) -> List[data.PredictedTag]:
+        """Get the species tags stored in the given time interval."""
+        return self.store.get_predicted_tags(  # type: ignore
+            **kwargs,
+            keys=[SPECIES_KEY],
+        )
+
+    def __getattr__(self, name: str):
+        return getattr(self.store, name)
+
+
+class SpeciesThresholdMessageBuilder(DetectionThresholdMessageBuilder):
+    """Message builder that only sends detections with a species tag.
+
+    Detections are included if their score meets the threshold and they
+    have a `species` tag. Their `channel` tags are kept in the message.
+    """
+
+    def filter_detections(
+        self, detections: List[data.Detection]
+    ) -> List[data.Detection]:
+        """Remove detections with low score or without a species tag."""
+        return [
+            detection
+            for detection in super().filter_detections(detections)
+            if any(tag.tag.key == SPECIES_KEY for tag in detection.tags)
+        ]
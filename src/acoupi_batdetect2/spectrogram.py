@@ -0,0 +1,303 @@
+"""Fast spectrogram computation for the BatDetect2 model.
+
+The `batdetect2` library computes the spectrogram of each recording with
+`librosa` and `numpy`, allocating new intermediate arrays at every step,
+and finally converts the result into a `torch` tensor. This module
+provides a drop-in replacement that reproduces the same computation but
+reuses preallocated buffers, window functions and interpolation weights
+across recordings of the same length, and writes the result directly into
+the tensor consumed by the network.
+
+To match `librosa`, the frames and their FFT are computed in double
+precision, a block of frames at a time. Only the audio, the cropped
+magnitudes and the output are stored in single precision.
+"""
+
+from typing import Dict, Optional, Tuple
+
+import numba
+import numpy as np
+import torch
+from batdetect2.detector import parameters
+from batdetect2.types import SpectrogramParameters
+from batdetect2.utils import audio_utils as au
+
+__all__ = [
+    "FastSpectrogram",
+]
+
+# Default PCEN parameters used by `librosa.pcen`. The PCEN kernel below
+# assumes a power of 0.5.
+PCEN_GAIN = 0.98
+PCEN_BIAS = 2.0
+PCEN_TIME_CONSTANT = 0.4
+PCEN_EPS = 1e-6
+PCEN_HOP_LENGTH = 512
+
+# BatDetect2 scales the spectrogram before applying PCEN.
+PCEN_INPUT_SCALE = 2**31
+
+# Number of STFT frames transformed at once. Keeps the double precision
+# FFT buffers small.
+FFT_BLOCK_FRAMES = 256
+
+
+@numba.njit(cache=True, nogil=True)
+def _magnitude(fft, rows, out):  # pragma: no cover
+    """Write the magnitude of the selected frequency bins into `out`.
+
+    The complex values are rounded to single precision before taking the
+    magnitude, as done by `librosa` when computing the STFT of `float32`
+    audio.
+    """
+    for time in range(fft.shape[0]):
+        for index in range(rows.shape[0]):
+            value = fft[time, rows[index]]
+            real = np.float32(value.real)
+            imag = np.float32(value.imag)
+            out[time, index] = np.sqrt(real * real + imag * imag)
+
+
+@numba.njit(cache=True, nogil=True)
+def _pcen(spec, state, b, scale):  # pragma: no cover
+    """Apply PCEN in place along the first (time) axis of `spec`.
+
+    Equivalent to `librosa.pcen` with its default parameters, using
+    `exp(-gain * log(eps + x)) = (eps + x) ** -gain` and
+    `expm1(0.5 * log1p(x)) = x / (sqrt(1 + x) + 1)` to reduce the number
+    of transcendental functions per value. The smoothing filter state is
+    kept in double precision, as in `librosa`.
+    """
+    offset = np.sqrt(PCEN_BIAS)
+    state[:] = 1.0
+    for time in range(spec.shape[0]):
+        for freq in range(spec.shape[1]):
+            value = spec[time, freq] * scale
+            state[freq] = b * value + (1 - b) * state[freq]
+            smooth = (PCEN_EPS + state[freq]) ** -PCEN_GAIN
+            ratio = value * smooth / PCEN_BIAS
+            spec[time, freq] = offset * ratio / (np.sqrt(1 + ratio) + 1)
+
+
+def _interpolation_weights(
+    input_size: int,
+    output_size: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the linear interpolation indices and weights.
+
+    Reproduces the source index computation of `torch.nn.functional.
+    interpolate` with `align_corners=False`.
+    """
+    scale = input_size / output_size
+    source = (np.arange(output_size) + 0.5) * scale - 0.5
+    source = np.clip(source, 0, None)
+    lower = np.floor(source).astype(np.int64)
+    upper = np.minimum(lower + 1, input_size - 1)
+    upper_weight = source - lower
+    return lower, upper, 1 - upper_weight, upper_weight
+
+
+class _SpectrogramPlan:
+    """Buffers and constants for recordings of a given length."""
+
+    def __init__(
+        self,
+        length: int,
+        samplerate: int,
+        params: SpectrogramParameters,
+    ):
+        self.params = params
+
+        window_length = params["fft_win_length"]
+        self.nfft = int(window_length * samplerate)
+        self.step = self.nfft - int(params["fft_overlap"] * self.nfft)
+
+        padded_length = au.pad_audio(
+            np.zeros(length, dtype=np.float32),
+            samplerate,
+            window_length,
+            params["fft_overlap"],
+            params["resize_factor"],
+            params["spec_divide_factor"],
+        ).shape[0]
+        num_frames = 1 + (padded_length - self.nfft) // self.step
+        num_bins = self.nfft // 2 + 1
+
+        max_bin = round(params["max_freq"] * window_length)
+        min_bin = round(params["min_freq"] * window_length)
+        if max_bin >= num_bins:
+            raise ValueError(
+                f"Sample rate {samplerate} Hz is too low for a maximum "
+                f"frequency of {params['max_freq']} Hz."
+            )
+
+        # Frequency bins, from highest to lowest, as in the library.
+        self.rows = np.arange(max_bin, min_bin, -1)
+
+        # As in `librosa`, the window and the FFT are computed in double
+        # precision, and only the magnitudes are stored in single precision.
+        block = min(FFT_BLOCK_FRAMES, num_frames)
+        self.audio = torch.zeros(padded_length, dtype=torch.float32)
+        self.window = torch.hann_window(
+            self.nfft,
+            periodic=True,
+            dtype=torch.float64,
+        )
+        self.frames = torch.empty((block, self.nfft), dtype=torch.float64)
+        self.fft = torch.empty((block, num_bins), dtype=torch.complex128)
+        self.cropped = torch.empty((num_frames, len(self.rows)))
+        self.pcen_state = np.empty(len(self.rows), dtype=np.float64)
+
+        t_frames = PCEN_TIME_CONSTANT * (samplerate / 10) / PCEN_HOP_LENGTH
+        self.pcen_b = (np.sqrt(1 + 4 * t_frames**2) - 1) / (2 * t_frames**2)
+        self.log_scaling = (
+            2.0
+            * (1.0 / samplerate)
+            * (1.0 / (np.abs(np.hanning(self.nfft)) ** 2).sum())
+        )
+
+        height = int(params["spec_height"] * params["resize_factor"])
+        width = int(num_frames * params["resize_factor"])
+
+        lower, upper, lower_weight, upper_weight = _interpolation_weights(
+            len(self.rows),
+            height,
+        )
+        height_weights = np.zeros((height, len(self.rows)), dtype=np.float32)
+        np.add.at(height_weights, (np.arange(height), lower), lower_weight)
+        np.add.at(height_weights, (np.arange(height), upper), upper_weight)
+        self.height_weights = torch.from_numpy(height_weights)
+        self.resized_height = torch.empty((height, num_frames))
+
+        lower, upper, lower_weight, upper_weight = _interpolation_weights(
+            num_frames,
+            width,
+        )
+        self.lower = torch.from_numpy(lower)
+        self.upper = torch.from_numpy(upper)
+        self.lower_weight = torch.from_numpy(lower_weight.astype(np.float32))
+        self.upper_weight = torch.from_numpy(upper_weight.astype(np.float32))
+        self.left = torch.empty((height, width))
+        self.right = torch.empty((height, width))
+
+        self.spec = torch.empty((1, 1, height, width))
+
+    def compute(self, audio: np.ndarray) -> torch.Tensor:
+        # The audio buffer tail is never written to, so it stays as the
+        # zero padding expected by the network.
+        self.audio[: audio.shape[0]].copy_(torch.from_numpy(audio))
+
+        frames = self.audio.unfold(0, self.nfft, self.step)
+        cropped = self.cropped.numpy()
+        block = self.frames.shape[0]
+        for start in range(0, frames.shape[0], block):
+            end = min(start + block, frames.shape[0])
+            size = end - start
+            torch.mul(frames[start:end], self.window, out=self.frames[:size])
+            torch.fft.rfft(self.frames[:size], dim=1, out=self.fft[:size])
+            _magnitude(self.fft[:size].numpy(), self.rows, cropped[start:end])
+
+        spec_scale = self.params["spec_scale"]
+        if spec_scale == "pcen":
+            _pcen(
+                cropped,
+                self.pcen_state,
+                self.pcen_b,
+                PCEN_INPUT_SCALE,
+            )
+        elif spec_scale == "log":
+            self.cropped.mul_(self.log_scaling).log1p_()
+
+        if self.params["denoise_spec_avg"]:
+            self.cropped.sub_(self.cropped.mean(dim=0)).clamp_(min=0)
+
+        if self.params["max_scale_spec"]:
+            self.cropped.div_(self.cropped.max() + 10e-6)
+
+        # Bilinear resize, first along frequency and then along time.
+        torch.matmul(
+            self.height_weights,
+            self.cropped.T,
+            out=self.resized_height,
+        )
+        torch.index_select(self.resized_height, 1, self.lower, out=self.left)
+        torch.index_select(self.resized_height, 1, self.upper, out=self.right)
+        self.left.mul_(self.lower_weight)
+        self.right.mul_(self.upper_weight)
+        torch.add(self.left, self.right, out=self.spec[0, 0])
+        return self.spec
+
+
+class FastSpectrogram:
+    """Compute BatDetect2 spectrograms with preallocated buffers.
+
+    Produces the same spectrogram as `batdetect2.api.generate_spectrogram`
+    but keeps one set of buffers per recording length. Since
+    recordings made by the program usually all have the same duration
+    and sample rate, the buffers are allocated once and reused for every
+    recording.
+
+    The computation runs on the CPU.
+
+    Attributes
+    ----------
+    samplerate : int
+        The sample rate of the audio, by default the BatDetect2 target
+        sample rate.
+    params : SpectrogramParameters
+        The spectrogram parameters, by default the BatDetect2 defaults.
+    max_plans : int
+        Maximum number of recording lengths for which buffers are kept.
+
+    Notes
+    -----
+    The returned tensor is owned by this object and will be overwritten
+    by the next call with audio of the same length. Clone it if it needs
+    to outlive the next call.
+    """
+
+    def __init__(
+        self,
+        samplerate: int = parameters.TARGET_SAMPLERATE_HZ,
+        params: Optional[SpectrogramParameters] = None,
+        max_plans: int = 4,
+    ):
+        """Initialise the fast spectrogram."""
+        if params is None:
+            params = parameters.DEFAULT_SPECTROGRAM_PARAMETERS
+
+        self.samplerate = samplerate
+        self.params = params
+        self.max_plans = max_plans
+        self._plans: Dict[int, _SpectrogramPlan] = {}
+
+    def __call__(self, audio: np.ndarray) -> torch.Tensor:
+        """Compute the spectrogram of the audio.
+
+        Parameters
+        ----------
+        audio : np.ndarray
+            The mono audio signal, sampled at `samplerate`.
+
+        Returns
+        -------
+        torch.Tensor
+            The spectrogram, with shape (1, 1, height, width), ready to be
+            processed by the network.
+        """
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        return self.get_plan(audio.shape[0]).compute(audio)
+
+    def get_plan(self, length: int) -> _SpectrogramPlan:
+        """Get the buffers for audio of the given length."""
+        plan = self._plans.get(length)
+        if plan is not None:
+            return plan
+
+        if len(self._plans) >= self.max_plans:
+            # Drop the oldest plan.
+            self._plans.pop(next(iter(self._plans)))
+
+        plan = _SpectrogramPlan(length, self.samplerate, self.params)
+        self._plans[length] = plan
+        return plan
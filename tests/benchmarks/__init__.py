@@ -0,0 +1,7 @@
+"""Micro benchmarks of the BatDetect2 Program.
+
+Measure the per-clip cost of decoding and resampling recordings at common
+field sample rates::
+
+    python -m tests.benchmarks.ingest --duration 3 --repeats 10
+"""
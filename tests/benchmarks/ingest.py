@@ -0,0 +1,164 @@
+"""Benchmark of the per-clip decode and resampling cost.
+
+Synthetic recordings are written at each sample rate and loaded with the
+library path (`librosa.load` followed by `librosa.resample`, as done by
+`batdetect2.api.load_audio`) and with `BatDetect2.load_audio`, which skips
+resampling at the model sample rate and reuses its polyphase filters.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Sequence
+
+import numpy as np
+import soundfile as sf
+from pydantic import BaseModel
+
+from acoupi_batdetect2.model import BatDetect2
+
+__all__ = [
+    "IngestResult",
+    "run_ingest_benchmark",
+]
+
+FIELD_SAMPLERATES = (96_000, 192_000, 250_000, 256_000, 384_000, 500_000)
+
+
+class IngestResult(BaseModel):
+    """Median cost of loading one clip at a sample rate."""
+
+    samplerate: int
+    decode_ms: float
+    library_ms: float
+    fast_ms: float
+
+    @property
+    def speedup(self) -> float:
+        return self.library_ms / self.fast_ms
+
+
+def _time(function: Callable[[], object], repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def _write_clip(
+    path: Path,
+    samplerate: int,
+    duration: float,
+    channels: int,
+) -> None:
+    rng = np.random.default_rng(0)
+    samples = rng.integers(
+        -(2**12),
+        2**12,
+        size=(int(samplerate * duration), channels),
+    )
+    sf.write(path, samples.astype(np.int16), samplerate, subtype="PCM_16")
+
+
+def run_ingest_benchmark(
+    workdir: Path,
+    samplerates: Sequence[int] = FIELD_SAMPLERATES,
+    duration: float = 3,
+    channels: int = 1,
+    repeats: int = 10,
+) -> List[IngestResult]:
+    """Measure the median cost of loading a clip at each sample rate."""
+    import librosa
+
+    model = BatDetect2()
+    target_samplerate = model.api.CONFIG["target_samp_rate"]  # type: ignore
+
+    def load_library(path: Path) -> np.ndarray:
+        audio, samplerate = librosa.load(path, sr=None, mono=False)
+        return librosa.resample(
+            audio,
+            orig_sr=samplerate,
+            target_sr=target_samplerate,
+            res_type="polyphase",
+            axis=-1,
+        )
+
+    results = []
+    for samplerate in samplerates:
+        path = workdir / f"clip_{samplerate}.wav"
+        _write_clip(path, samplerate, duration, channels)
+
+        decode = partial(sf.read, path, dtype="float32")
+        library = partial(load_library, path)
+        fast = partial(model.load_audio, str(path))
+
+        # Warm up both paths, so that filter design is only measured
+        # where it happens on every clip.
+        library()
+        fast()
+
+        results.append(
+            IngestResult(
+                samplerate=samplerate,
+                decode_ms=_time(decode, repeats),
+                library_ms=_time(library, repeats),
+                fast_ms=_time(fast, repeats),
+            )
+        )
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmarks.ingest",
+        description=(
+            "Measure the per-clip cost of decoding and resampling "
+            "recordings at common field sample rates."
+        ),
+    )
+    parser.add_argument(
+        "--samplerates",
+        type=int,
+        nargs="+",
+        default=list(FIELD_SAMPLERATES),
+        help="Sample rates of the synthetic recordings, in Hz.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3,
+        help="Duration of each recording, in seconds.",
+    )
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_ingest_benchmark(
+            Path(workdir),
+            samplerates=args.samplerates,
+            duration=args.duration,
+            channels=args.channels,
+            repeats=args.repeats,
+        )
+
+    print(
+        f"{'samplerate':>10} {'decode ms':>10} {'library ms':>11} "
+        f"{'fast ms':>8} {'speedup':>8}"
+    )
+    for result in results:
+        print(
+            f"{result.samplerate:>10} {result.decode_ms:>10.1f} "
+            f"{result.library_ms:>11.1f} {result.fast_ms:>8.1f} "
+            f"{result.speedup:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
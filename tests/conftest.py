@@ -2,14 +2,12 @@
 
 import datetime
 from pathlib import Path
+from typing import Callable, Sequence, Tuple
 
 import pytest
 from acoupi import data
-from acoupi.components import HTTPConfig, MicrophoneConfig
-from acoupi.programs.templates import (
-    MessagingConfig,
-    PathsConfiguration,
-)
+from acoupi.components import HTTPConfig, MicrophoneConfig, SqliteStore
+from acoupi.programs.templates import MessagingConfig
 from acoupi.system.constants import CeleryConfig
 from celery import Celery
 from celery.worker import WorkController
@@ -17,6 +15,8 @@ from celery.worker import WorkController
 from acoupi_batdetect2.configuration import (
     BatDetect2_AudioConfig,
     BatDetect2_ConfigSchema,
+    BatDetect2_PathsConfig,
+    MetricsConfig,
 )
 from acoupi_batdetect2.program import BatDetect2_Program
 
@@ -24,6 +24,7 @@ pytest_plugins = ("celery.contrib.pytest",)
 
 TESTS_DIR = Path(__file__).parent
 TEST_RECORDING = TESTS_DIR / "data" / "audiofile_test1_myomys.wav"
+TEST_RECORDING_PIPPIP = TESTS_DIR / "data" / "audiofile_test2_pippip.wav"
 TEST_RECORDING_NOBAT = TESTS_DIR / "data" / "audiofile_test3_nobats.wav"
 
 
@@ -47,6 +48,19 @@ def recording() -> data.Recording:
     )
 
 
+@pytest.fixture
+def pippip_recording() -> data.Recording:
+    return data.Recording(
+        path=TEST_RECORDING_PIPPIP,
+        duration=3,
+        samplerate=192000,
+        created_on=datetime.datetime.now(),
+        deployment=data.Deployment(
+            name="test_pippip",
+        ),
+    )
+
+
 @pytest.fixture
 def notbat_recording() -> data.Recording:
     return data.Recording(
@@ -61,15 +75,65 @@ def notbat_recording() -> data.Recording:
 
 
 @pytest.fixture
-def paths_config(tmp_path: Path) -> PathsConfiguration:
+def store_model_output() -> Callable[..., data.ModelOutput]:
+    """Store a recording and its model output, created at a given time.
+
+    Each call is a detection given as (start_time, low_freq, end_time,
+    high_freq, species).
+    """
+
+    def store_model_output(
+        store: SqliteStore,
+        created_on: datetime.datetime,
+        calls: Sequence[Tuple[float, float, float, float, str]] = (
+            (0.1, 30000, 0.11, 60000, "Myotis"),
+        ),
+    ) -> data.ModelOutput:
+        recording = data.Recording(
+            path=Path(f"{created_on:%Y%m%d_%H%M%S}.wav"),
+            duration=3,
+            samplerate=256000,
+            created_on=created_on,
+            deployment=store.get_current_deployment(),
+        )
+        model_output = data.ModelOutput(
+            name_model="BatDetect2",
+            recording=recording,
+            created_on=created_on,
+            detections=[
+                data.Detection(
+                    detection_score=0.9,
+                    location=data.BoundingBox.from_coordinates(
+                        start, low, end, high
+                    ),
+                    tags=[
+                        data.PredictedTag(
+                            tag=data.Tag(key="species", value=species),
+                            confidence_score=0.8,
+                        )
+                    ],
+                )
+                for start, low, end, high, species in calls
+            ],
+        )
+        store.store_recording(recording)
+        store.store_model_output(model_output)
+        return model_output
+
+    return store_model_output
+
+
+@pytest.fixture
+def paths_config(tmp_path: Path) -> BatDetect2_PathsConfig:
     tmp_audio = tmp_path / "tmp"
     recordings = tmp_path / "audio"
     tmp_audio.mkdir(parents=True, exist_ok=True)
     recordings.mkdir(parents=True, exist_ok=True)
-    return PathsConfiguration(
+    return BatDetect2_PathsConfig(
         tmp_audio=tmp_path / "tmp",
         recordings=tmp_path / "audio",
         db_metadata=tmp_path / "metadata.db",
+        cache=tmp_path / "cache",
     )
 
 
@@ -97,12 +161,21 @@ def messaging_config(tmp_path: Path) -> MessagingConfig:
     )
 
 
+@pytest.fixture
+def metrics_config(tmp_path: Path) -> MetricsConfig:
+    return MetricsConfig(
+        db_path=tmp_path / "metrics.db",
+        textfile=tmp_path / "metrics" / "acoupi_batdetect2.prom",
+    )
+
+
 @pytest.fixture
 def program_config(
     messaging_config: MessagingConfig,
-    paths_config: PathsConfiguration,
+    paths_config: BatDetect2_PathsConfig,
     audio_config: BatDetect2_AudioConfig,
     microphone_config: MicrophoneConfig,
+    metrics_config: MetricsConfig,
 ) -> BatDetect2_ConfigSchema:
     return BatDetect2_ConfigSchema(
         paths=paths_config,
@@ -110,6 +183,7 @@ def program_config(
         recording=audio_config,
         microphone=microphone_config,
         saving_filters=None,
+        metrics=metrics_config,
     )
 
 
@@ -118,6 +192,12 @@ def celery_config():
     return CeleryConfig().model_dump()
 
 
+@pytest.fixture(scope="session")
+def celery_worker_parameters():
+    # The test worker must consume from every queue the program routes to.
+    return {"queues": BatDetect2_Program.get_queue_names()}
+
+
 @pytest.fixture
 def program(
     program_config: BatDetect2_ConfigSchema,
@@ -0,0 +1,18 @@
+"""Soak and load testing of the BatDetect2 Program.
+
+Run the full pipeline against a simulated microphone for a configurable
+duration and clip rate, and report throughput, per-task latency and
+backlog growth::
+
+    python -m tests.soak --duration 3600 --interval 5 --output report.json
+"""
+
+from .harness import SoakConfig, SoakReport, run_soak
+from .microphone import SyntheticRecorder
+
+__all__ = [
+    "SoakConfig",
+    "SoakReport",
+    "SyntheticRecorder",
+    "run_soak",
+]
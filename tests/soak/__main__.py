@@ -0,0 +1,93 @@
+"""Command line entry point of the soak test harness."""
+
+import argparse
+import tempfile
+from pathlib import Path
+
+from .harness import SoakConfig, run_soak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.soak",
+        description=(
+            "Run the BatDetect2 pipeline against a simulated microphone "
+            "and report throughput, task latency and backlog growth."
+        ),
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=SoakConfig().duration,
+        help="Seconds during which recordings are made.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=SoakConfig().recording_interval,
+        help="Seconds between synthetic recordings.",
+    )
+    parser.add_argument(
+        "--clip-duration",
+        type=int,
+        default=SoakConfig().clip_duration,
+        help="Duration of each synthetic recording, in seconds.",
+    )
+    parser.add_argument(
+        "--samplerate",
+        type=int,
+        default=SoakConfig().samplerate,
+        help="Sample rate of the synthetic recordings, in Hz.",
+    )
+    parser.add_argument(
+        "--call-probability",
+        type=float,
+        default=SoakConfig().call_probability,
+        help="Probability that a recording contains bat-like calls.",
+    )
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        default=SoakConfig().sample_interval,
+        help="Seconds between backlog and memory samples.",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=None,
+        help="Directory for recordings and databases. Temporary if unset.",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="Write the report as JSON to this file.",
+    )
+    args = parser.parse_args()
+
+    config = SoakConfig(
+        duration=args.duration,
+        recording_interval=args.interval,
+        clip_duration=args.clip_duration,
+        samplerate=args.samplerate,
+        call_probability=args.call_probability,
+        sample_interval=args.sample_interval,
+        seed=args.seed,
+    )
+
+    if args.workdir is not None:
+        args.workdir.mkdir(parents=True, exist_ok=True)
+        report = run_soak(config, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            report = run_soak(config, Path(workdir))
+
+    print(report.summary())
+
+    if args.output is not None:
+        args.output.write_text(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
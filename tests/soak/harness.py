@@ -0,0 +1,494 @@
+"""Soak test harness for the BatDetect2 Program.
+
+Runs the full BatDetect2 pipeline (recording, detection, file management,
+messaging and summary tasks) on an in-memory Celery broker, with the
+microphone replaced by a `SyntheticRecorder` and the messenger replaced
+by an in-memory one. One embedded worker is started per worker of the
+program's worker configuration, so that task routing and concurrency
+match a deployment.
+
+While the pipeline runs, the harness records the queue wait and run time
+of every task, and periodically samples the backlog (pending temporary
+files, unsent messages and tasks in flight) and the process memory.
+"""
+
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from acoupi import data
+from acoupi.components import MicrophoneConfig, types
+from acoupi.programs.templates import MessagingConfig
+from acoupi.system.constants import CeleryConfig
+from acoupi.system.files import get_temp_files
+from celery import Celery, signals
+from celery.contrib.testing.worker import start_worker
+from pydantic import BaseModel, Field
+
+from .microphone import SyntheticRecorder
+from acoupi_batdetect2.configuration import (
+    BatDetect2_AudioConfig,
+    BatDetect2_ConfigSchema,
+    BatDetect2_PathsConfig,
+    MetricsConfig,
+)
+from acoupi_batdetect2.program import BatDetect2_Program
+
+__all__ = [
+    "SoakConfig",
+    "SoakReport",
+    "run_soak",
+]
+
+
+class SoakConfig(BaseModel):
+    """Soak test configuration."""
+
+    duration: float = 300
+    """Duration (in seconds) during which recordings are made."""
+
+    recording_interval: float = 5
+    """Interval (in seconds) between synthetic recordings."""
+
+    clip_duration: int = 3
+    """Duration (in seconds) of each synthetic recording."""
+
+    samplerate: int = 256_000
+    """Sample rate (in Hz) of the synthetic recordings."""
+
+    call_probability: float = 0.5
+    """Probability that a recording contains bat-call-like chirps."""
+
+    management_interval: float = 30
+    """Interval (in seconds) between file management runs."""
+
+    messaging_interval: float = 30
+    """Interval (in seconds) between message sending runs."""
+
+    summary_interval: float = 60
+    """Interval (in seconds) between summary runs."""
+
+    sample_interval: float = 5
+    """Interval (in seconds) between backlog and memory samples."""
+
+    drain_timeout: float = 120
+    """Maximum time (in seconds) to wait for the backlog to clear."""
+
+    seed: Optional[int] = None
+    """Seed of the synthetic audio generator."""
+
+
+class TaskStats(BaseModel):
+    """Latency statistics of a task, in seconds."""
+
+    count: int
+    failures: int
+    wait_p50: float
+    wait_p95: float
+    wait_p99: float
+    run_p50: float
+    run_p95: float
+    run_p99: float
+    run_max: float
+
+
+class BacklogSample(BaseModel):
+    """Backlog and memory at a point in time."""
+
+    elapsed: float
+    pending_files: int
+    unsent_messages: int
+    in_flight: Dict[str, int]
+    rss_mb: float
+
+
+class SoakReport(BaseModel):
+    """Results of a soak run."""
+
+    elapsed: float
+    """Total duration of the run (in seconds), including draining."""
+
+    recordings: int
+    """Number of recordings made."""
+
+    processed: int
+    """Number of recordings processed by the detection task."""
+
+    throughput: float
+    """Recordings processed per minute."""
+
+    tasks: Dict[str, TaskStats] = Field(default_factory=dict)
+
+    samples: List[BacklogSample] = Field(default_factory=list)
+
+    def summary(self) -> str:
+        """Format the report as a human readable table."""
+        lines = [
+            f"Elapsed: {self.elapsed:.1f} s",
+            f"Recordings: {self.recordings} made, {self.processed} processed"
+            f" ({self.throughput:.2f}/min)",
+            "",
+            f"{'task':<24}{'count':>7}{'fail':>6}"
+            f"{'wait p50':>10}{'wait p95':>10}"
+            f"{'run p50':>10}{'run p95':>10}{'run p99':>10}{'run max':>10}",
+        ]
+        for name, stats in sorted(self.tasks.items()):
+            lines.append(
+                f"{name:<24}{stats.count:>7}{stats.failures:>6}"
+                f"{stats.wait_p50:>10.3f}{stats.wait_p95:>10.3f}"
+                f"{stats.run_p50:>10.3f}{stats.run_p95:>10.3f}"
+                f"{stats.run_p99:>10.3f}{stats.run_max:>10.3f}"
+            )
+
+        lines.extend(
+            [
+                "",
+                f"{'elapsed':>8}{'files':>7}{'unsent':>8}"
+                f"{'in flight':>11}{'rss (MB)':>10}",
+            ]
+        )
+        for sample in self.samples:
+            lines.append(
+                f"{sample.elapsed:>8.1f}{sample.pending_files:>7}"
+                f"{sample.unsent_messages:>8}"
+                f"{sum(sample.in_flight.values()):>11}"
+                f"{sample.rss_mb:>10.1f}"
+            )
+
+        return "\n".join(lines)
+
+
+class MemoryMessenger(types.Messenger):
+    """Messenger that keeps sent messages in memory."""
+
+    def __init__(self):
+        self.sent: List[data.Message] = []
+
+    def send_message(self, message: data.Message) -> data.Response:
+        self.sent.append(message)
+        return data.Response(
+            status=data.ResponseStatus.SUCCESS,
+            message=message,
+        )
+
+
+class SoakProgram(BatDetect2_Program):
+    """BatDetect2 Program with a synthetic microphone and messenger."""
+
+    def __init__(
+        self,
+        program_config: BatDetect2_ConfigSchema,
+        app: Celery,
+        call_probability: float = 0.5,
+        seed: Optional[int] = None,
+    ):
+        self.call_probability = call_probability
+        self.seed = seed
+        super().__init__(program_config=program_config, app=app)
+
+    def configure_recorder(self, config):
+        return SyntheticRecorder(
+            duration=config.recording.duration,
+            samplerate=config.microphone.samplerate,
+            audio_dir=config.paths.tmp_audio,
+            call_probability=self.call_probability,
+            seed=self.seed,
+        )
+
+    def configure_messenger(self, config):
+        return MemoryMessenger()
+
+    def get_recording_conditions(self, config):
+        # Record regardless of the time of day.
+        return []
+
+
+class TaskMonitor:
+    """Record queue wait and run time of tasks from Celery signals."""
+
+    def __init__(self, task_names: List[str]):
+        self.task_names = set(task_names)
+        self.lock = threading.Lock()
+        self.published: Dict[str, float] = {}
+        self.started: Dict[str, float] = {}
+        self.waits: Dict[str, List[float]] = defaultdict(list)
+        self.runs: Dict[str, List[float]] = defaultdict(list)
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.sent: Dict[str, int] = defaultdict(int)
+        self.finished: Dict[str, int] = defaultdict(int)
+
+    def connect(self) -> None:
+        signals.before_task_publish.connect(self.on_publish)
+        signals.task_prerun.connect(self.on_prerun)
+        signals.task_postrun.connect(self.on_postrun)
+        signals.task_failure.connect(self.on_failure)
+
+    def disconnect(self) -> None:
+        signals.before_task_publish.disconnect(self.on_publish)
+        signals.task_prerun.disconnect(self.on_prerun)
+        signals.task_postrun.disconnect(self.on_postrun)
+        signals.task_failure.disconnect(self.on_failure)
+
+    def on_publish(self, sender=None, headers=None, **kwargs):
+        if sender not in self.task_names or not headers:
+            return
+
+        with self.lock:
+            self.published[headers["id"]] = time.monotonic()
+            self.sent[sender] += 1
+
+    def on_prerun(self, task_id=None, task=None, **kwargs):
+        if task is None or task.name not in self.task_names:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            self.started[task_id] = now
+            published = self.published.pop(task_id, None)
+            if published is not None:
+                self.waits[task.name].append(now - published)
+
+    def on_postrun(self, task_id=None, task=None, **kwargs):
+        if task is None or task.name not in self.task_names:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            started = self.started.pop(task_id, None)
+            if started is not None:
+                self.runs[task.name].append(now - started)
+            self.finished[task.name] += 1
+
+    def on_failure(self, sender=None, **kwargs):
+        if sender is None or sender.name not in self.task_names:
+            return
+
+        with self.lock:
+            self.failures[sender.name] += 1
+
+    def in_flight(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                name: self.sent[name] - self.finished[name]
+                for name in self.sent
+            }
+
+    def stats(self) -> Dict[str, TaskStats]:
+        with self.lock:
+            return {
+                name: TaskStats(
+                    count=len(runs),
+                    failures=self.failures[name],
+                    wait_p50=_percentile(self.waits[name], 50),
+                    wait_p95=_percentile(self.waits[name], 95),
+                    wait_p99=_percentile(self.waits[name], 99),
+                    run_p50=_percentile(runs, 50),
+                    run_p95=_percentile(runs, 95),
+                    run_p99=_percentile(runs, 99),
+                    run_max=max(runs, default=0),
+                )
+                for name, runs in self.runs.items()
+            }
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0
+
+    values = sorted(values)
+    index = round(percent / 100 * (len(values) - 1))
+    return values[index]
+
+
+def _rss_mb() -> float:
+    """Get the resident memory of the process, in MB."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # Peak memory, in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def create_program(
+    config: SoakConfig,
+    workdir: Path,
+    app: Celery,
+) -> SoakProgram:
+    """Create a soak program storing all its data in `workdir`."""
+    tmp_audio = workdir / "tmp"
+    tmp_audio.mkdir(parents=True, exist_ok=True)
+
+    program_config = BatDetect2_ConfigSchema(
+        paths=BatDetect2_PathsConfig(
+            tmp_audio=tmp_audio,
+            recordings=workdir / "audio",
+            db_metadata=workdir / "metadata.db",
+            cache=workdir / "cache",
+        ),
+        microphone=MicrophoneConfig(
+            samplerate=config.samplerate,
+            audio_channels=1,
+            device_name="synthetic",
+        ),
+        recording=BatDetect2_AudioConfig(
+            duration=config.clip_duration,
+            interval=max(int(config.recording_interval), 1),
+        ),
+        messaging=MessagingConfig(messages_db=workdir / "messages.db"),
+        saving_filters=None,
+        metrics=MetricsConfig(
+            db_path=workdir / "metrics.db",
+            textfile=workdir / "metrics" / "acoupi_batdetect2.prom",
+        ),
+    )
+
+    return SoakProgram(
+        program_config=program_config,
+        app=app,
+        call_probability=config.call_probability,
+        seed=config.seed,
+    )
+
+
+def run_soak(config: SoakConfig, workdir: Path) -> SoakReport:
+    """Run the BatDetect2 pipeline under sustained load.
+
+    Parameters
+    ----------
+    config : SoakConfig
+        The soak test configuration.
+    workdir : Path
+        Directory where recordings and databases are stored.
+
+    Returns
+    -------
+    SoakReport
+        Throughput, per-task latency statistics and backlog samples.
+    """
+    app = Celery("acoupi_batdetect2_soak")
+    app.conf.update(
+        {
+            **CeleryConfig().model_dump(),
+            "broker_url": "memory://",
+            "result_backend": "cache+memory://",
+        }
+    )
+
+    program = create_program(config, workdir, app)
+    program.on_start(data.Deployment(name="soak"))
+
+    intervals = {
+        "recording_task": config.recording_interval,
+        "file_management_task": config.management_interval,
+        "send_messages_task": config.messaging_interval,
+        "summary_task": config.summary_interval,
+        "metrics_task": config.management_interval,
+    }
+    intervals = {
+        name: interval
+        for name, interval in intervals.items()
+        if name in program.tasks
+    }
+
+    monitor = TaskMonitor(list(program.tasks))
+    monitor.connect()
+
+    samples: List[BacklogSample] = []
+    start = time.monotonic()
+
+    def sample() -> None:
+        samples.append(
+            BacklogSample(
+                elapsed=time.monotonic() - start,
+                pending_files=len(
+                    get_temp_files(program.config.paths.tmp_audio)
+                ),
+                unsent_messages=len(
+                    program.message_store.get_unsent_messages()
+                ),
+                in_flight=monitor.in_flight(),
+                rss_mb=_rss_mb(),
+            )
+        )
+
+    try:
+        with ExitStack() as stack:
+            for worker in program.get_worker_config().workers:
+                stack.enter_context(
+                    start_worker(
+                        app,
+                        concurrency=worker.concurrency or 4,
+                        pool="threads",
+                        queues=worker.queues,
+                        hostname=f"{worker.name}@soak",
+                        perform_ping_check=False,
+                        loglevel="WARNING",
+                        shutdown_timeout=config.drain_timeout,
+                    )
+                )
+
+            next_run = {name: start for name in intervals}
+            next_sample = start
+            end = start + config.duration
+
+            while time.monotonic() < end:
+                now = time.monotonic()
+                for name, interval in intervals.items():
+                    if now >= next_run[name]:
+                        program.tasks[name].delay()
+                        next_run[name] += interval
+
+                if now >= next_sample:
+                    sample()
+                    next_sample += config.sample_interval
+
+                wake = min([*next_run.values(), next_sample, end])
+                time.sleep(max(wake - time.monotonic(), 0))
+
+            # Stop recording and let the pipeline clear the backlog.
+            deadline = time.monotonic() + config.drain_timeout
+            while time.monotonic() < deadline:
+                if not any(monitor.in_flight().values()):
+                    program.tasks["file_management_task"].delay()
+                    if "send_messages_task" in program.tasks:
+                        program.tasks["send_messages_task"].delay()
+
+                time.sleep(config.sample_interval)
+                sample()
+
+                last = samples[-1]
+                if (
+                    last.pending_files == 0
+                    and last.unsent_messages == 0
+                    and not any(last.in_flight.values())
+                ):
+                    break
+    finally:
+        monitor.disconnect()
+
+    elapsed = time.monotonic() - start
+    stats = monitor.stats()
+    recordings = (
+        stats["recording_task"].count if "recording_task" in stats else 0
+    )
+    processed = (
+        stats["detection_task"].count if "detection_task" in stats else 0
+    )
+
+    return SoakReport(
+        elapsed=elapsed,
+        recordings=recordings,
+        processed=processed,
+        throughput=processed / (elapsed / 60),
+        tasks=stats,
+        samples=samples,
+    )
@@ -0,0 +1,110 @@
+"""Synthetic microphone for soak testing.
+
+Replaces the PyAudio recorder with a source that writes synthetic clips to
+the temporary audio directory. Each clip contains background noise and,
+with a configurable probability, a sequence of bat-call-like frequency
+modulated chirps.
+"""
+
+import datetime
+import wave
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from acoupi import data
+from acoupi.components import types
+
+
+class SyntheticRecorder(types.AudioRecorder):
+    """Audio recorder that generates synthetic clips.
+
+    Attributes
+    ----------
+    duration : float
+        Duration of each clip in seconds.
+    samplerate : int
+        Sample rate of the clips in Hz.
+    audio_dir : Path
+        Directory where the clips are written.
+    call_probability : float
+        Probability that a clip contains bat-call-like chirps. The other
+        clips only contain background noise.
+    noise_level : float
+        Amplitude of the background noise, relative to full scale.
+    """
+
+    def __init__(
+        self,
+        duration: float,
+        samplerate: int,
+        audio_dir: Path,
+        call_probability: float = 0.5,
+        noise_level: float = 0.005,
+        seed: Optional[int] = None,
+    ):
+        self.duration = duration
+        self.samplerate = samplerate
+        self.audio_dir = audio_dir
+        self.call_probability = call_probability
+        self.noise_level = noise_level
+        self.rng = np.random.default_rng(seed)
+
+    def record(self, deployment: data.Deployment) -> data.Recording:
+        """Write a synthetic clip and return the recording."""
+        now = datetime.datetime.now()
+        path = self.audio_dir / f"{now.strftime('%Y%m%d_%H%M%S_%f')}.wav"
+
+        audio = self.generate()
+        with wave.open(str(path), "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.samplerate)
+            wav.writeframes((audio * 32767).astype("<i2").tobytes())
+
+        return data.Recording(
+            path=path,
+            duration=self.duration,
+            samplerate=self.samplerate,
+            created_on=now,
+            deployment=deployment,
+        )
+
+    def generate(self) -> np.ndarray:
+        """Generate the samples of a single clip."""
+        num_samples = int(self.duration * self.samplerate)
+        audio = self.rng.normal(0, self.noise_level, num_samples)
+
+        if self.rng.random() < self.call_probability:
+            self.add_chirps(audio)
+
+        return np.clip(audio, -1, 1)
+
+    def add_chirps(self, audio: np.ndarray) -> None:
+        """Add a pass of echolocation-like calls to the audio, in place.
+
+        Calls are steep downward sweeps of a few milliseconds, repeated
+        at a regular interval, similar to Pipistrellus or Myotis calls.
+        """
+        call_duration = self.rng.uniform(0.003, 0.008)
+        call_interval = self.rng.uniform(0.06, 0.12)
+        start_freq = min(
+            self.rng.uniform(60_000, 100_000),
+            0.45 * self.samplerate,
+        )
+        end_freq = self.rng.uniform(25_000, 50_000)
+        amplitude = self.rng.uniform(0.1, 0.5)
+
+        call_samples = int(call_duration * self.samplerate)
+        time = np.arange(call_samples) / self.samplerate
+
+        # Exponential sweep from start_freq to end_freq.
+        rate = np.log(end_freq / start_freq) / call_duration
+        phase = 2 * np.pi * start_freq * np.expm1(rate * time) / rate
+        call = amplitude * np.hanning(call_samples) * np.sin(phase)
+
+        start = self.rng.uniform(0, call_interval)
+        while start + call_duration < self.duration:
+            index = int(start * self.samplerate)
+            audio[index : index + call_samples] += call
+            start += call_interval
@@ -0,0 +1,63 @@
+import os
+from pathlib import Path
+
+import numba
+import pytest
+
+from acoupi_batdetect2 import cache
+from acoupi_batdetect2.cache import CompileCache
+
+
+@pytest.fixture(autouse=True)
+def restore_numba_cache_dir(monkeypatch):
+    monkeypatch.setenv(
+        "NUMBA_CACHE_DIR", os.environ.get("NUMBA_CACHE_DIR", "")
+    )
+    monkeypatch.setattr(numba.config, "CACHE_DIR", numba.config.CACHE_DIR)
+
+
+def test_compile_cache_is_keyed_by_versions(tmp_path: Path, monkeypatch):
+    model_path = tmp_path / "model.pth.tar"
+    model_path.write_bytes(b"weights")
+    directory = tmp_path / "cache"
+
+    compile_cache = CompileCache(directory, model_path=model_path)
+    path = compile_cache.activate()
+
+    assert path == directory / compile_cache.key
+    assert compile_cache.numba_dir.is_dir()
+    assert os.environ["NUMBA_CACHE_DIR"] == str(compile_cache.numba_dir)
+    assert numba.config.CACHE_DIR == str(compile_cache.numba_dir)
+
+    # The same versions reuse the same cache.
+    assert CompileCache(directory, model_path=model_path).key == (
+        compile_cache.key
+    )
+
+    # A new model invalidates the cache.
+    model_path.write_bytes(b"new weights")
+    retrained = CompileCache(directory, model_path=model_path)
+    assert retrained.key != compile_cache.key
+
+    # A library upgrade invalidates the cache.
+    monkeypatch.setattr(cache, "_get_version", lambda package: "99.0")
+    upgraded = CompileCache(directory, model_path=model_path)
+    assert upgraded.key not in {compile_cache.key, retrained.key}
+
+    # Stale caches are removed on activation.
+    upgraded.activate()
+    assert [path.name for path in directory.iterdir()] == [upgraded.key]
+
+
+def test_compiled_functions_are_stored_in_cache(tmp_path: Path):
+    model_path = tmp_path / "model.pth.tar"
+    model_path.write_bytes(b"weights")
+    compile_cache = CompileCache(tmp_path / "cache", model_path=model_path)
+    compile_cache.activate()
+
+    @numba.njit(cache=True)
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3
+    assert any(compile_cache.numba_dir.rglob("*.nbi"))
@@ -0,0 +1,142 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+from acoupi import data
+from acoupi.components import SqliteStore
+
+from acoupi_batdetect2.compression import (
+    FlacEncoder,
+    find_pending_recordings,
+    generate_compression_task,
+    get_failed_marker,
+)
+
+SAMPLERATE = 500_000
+
+
+def write_wav(path: Path, subtype: str = "PCM_16") -> np.ndarray:
+    # Quiet background noise, as in most field recordings.
+    rng = np.random.default_rng(0)
+    samples = rng.integers(-256, 256, size=(SAMPLERATE, 2))
+    samples = samples.astype(np.int16)
+    sf.write(path, samples, SAMPLERATE, subtype=subtype)
+    return samples
+
+
+def test_flac_encoding_is_lossless(tmp_path: Path):
+    path = tmp_path / "recording.wav"
+    samples = write_wav(path)
+
+    flac_path = FlacEncoder(block_frames=10_000).encode(path)
+
+    assert flac_path == tmp_path / "recording.flac"
+    assert path.exists()
+
+    decoded, samplerate = sf.read(flac_path, dtype="int16")
+    assert samplerate == SAMPLERATE
+    assert np.array_equal(decoded, samples)
+    assert flac_path.stat().st_size < path.stat().st_size
+
+
+def test_flac_encoding_resumes_interrupted_runs(tmp_path: Path):
+    encoder = FlacEncoder()
+    path = tmp_path / "recording.wav"
+    write_wav(path)
+
+    # A partial file left by an interrupted run is overwritten.
+    partial_path = tmp_path / ".recording.flac.partial"
+    partial_path.write_bytes(b"truncated")
+    flac_path = encoder.encode(path)
+    assert not partial_path.exists()
+    assert encoder.verify(path, flac_path)
+
+    # A verified FLAC file is reused.
+    modified = flac_path.stat().st_mtime_ns
+    assert encoder.encode(path) == flac_path
+    assert flac_path.stat().st_mtime_ns == modified
+
+    # A corrupted FLAC file is encoded again.
+    flac_path.write_bytes(b"corrupted")
+    assert not encoder.verify(path, flac_path)
+    encoder.encode(path)
+    assert encoder.verify(path, flac_path)
+
+
+def test_compression_task_updates_the_store(tmp_path: Path):
+    directory = tmp_path / "bats"
+    directory.mkdir()
+    path = directory / "recording.wav"
+    write_wav(path)
+    float_path = directory / "float.wav"
+    write_wav(float_path, subtype="FLOAT")
+
+    store = SqliteStore(tmp_path / "metadata.db")
+    recording = data.Recording(
+        path=path,
+        duration=1,
+        samplerate=SAMPLERATE,
+        created_on=datetime.datetime.now(),
+        deployment=store.get_current_deployment(),
+    )
+    store.store_recording(recording)
+
+    assert find_pending_recordings([directory], min_age=3600) == []
+
+    task = generate_compression_task(
+        directories=[directory, tmp_path / "missing"],
+        store=store,
+        encoder=FlacEncoder(),
+        min_age=0,
+        niceness=0,
+    )
+    task()
+
+    assert not path.exists()
+    assert path.with_suffix(".flac").exists()
+
+    # Floating point recordings can not be compressed losslessly.
+    assert float_path.exists()
+    assert not float_path.with_suffix(".flac").exists()
+
+    ((stored, _),) = store.get_recordings(ids=[recording.id])
+    assert stored.path == path.with_suffix(".flac")
+
+
+def test_compression_task_skips_failed_recordings(tmp_path: Path):
+    directory = tmp_path / "bats"
+    directory.mkdir()
+
+    # Sorted before the valid recordings.
+    float_path = directory / "a_float.wav"
+    write_wav(float_path, subtype="FLOAT")
+    truncated_path = directory / "b_truncated.wav"
+    write_wav(truncated_path)
+    truncated_path.write_bytes(truncated_path.read_bytes()[:30])
+    paths = [directory / "c_recording.wav", directory / "d_recording.wav"]
+    for path in paths:
+        write_wav(path)
+
+    assert find_pending_recordings([directory]) == [truncated_path, *paths]
+
+    task = generate_compression_task(
+        directories=[directory],
+        store=SqliteStore(tmp_path / "metadata.db"),
+        encoder=FlacEncoder(),
+        max_files=1,
+        min_age=0,
+        niceness=0,
+    )
+
+    # The truncated file is attempted once and then skipped.
+    task()
+    assert get_failed_marker(truncated_path).exists()
+    assert not get_failed_marker(float_path).exists()
+    assert find_pending_recordings([directory]) == paths
+
+    task()
+    task()
+    assert all(path.with_suffix(".flac").exists() for path in paths)
+    assert float_path.exists()
+    assert truncated_path.exists()
@@ -0,0 +1,107 @@
+import datetime
+import shutil
+import uuid
+from pathlib import Path
+
+from acoupi import data
+from acoupi.components import SqliteMessageStore, SqliteStore
+
+from acoupi_batdetect2.detection import (
+    UnprocessedRecordingFilter,
+    generate_pipelined_detection_task,
+)
+from acoupi_batdetect2.model import BatDetect2
+
+
+class SkipRecording:
+    def __init__(self, skipped: data.Recording):
+        self.skipped = skipped
+
+    def should_process_recording(self, recording: data.Recording) -> bool:
+        return recording.id != self.skipped.id
+
+
+def test_pipelined_detection_task_processes_backlog(
+    tmp_path: Path,
+    recording: data.Recording,
+    notbat_recording: data.Recording,
+):
+    store = SqliteStore(tmp_path / "metadata.db")
+    message_store = SqliteMessageStore(tmp_path / "messages.db")
+    tmp_audio = tmp_path / "tmp"
+    tmp_audio.mkdir()
+
+    def waiting(source: data.Recording, name: str, age: float):
+        path = tmp_audio / name
+        shutil.copy(source.path, path)
+        return source.model_copy(
+            update={
+                "id": uuid.uuid4(),
+                "path": path,
+                "created_on": datetime.datetime.now()
+                - datetime.timedelta(seconds=age),
+            }
+        )
+
+    bats = waiting(recording, "bats.wav", 3600)
+    notbats = waiting(notbat_recording, "notbats.wav", 3500)
+    broken = waiting(recording, "broken.wav", 3400)
+    broken.path.write_bytes(b"not audio")
+    skipped = waiting(recording, "skipped.wav", 3300)
+    recent = waiting(recording, "recent.wav", 0)
+    recordings = [bats, notbats, broken, skipped, recent]
+    for item in recordings:
+        store.store_recording(item)
+
+    def create_task(min_age: float):
+        return generate_pipelined_detection_task(
+            store=store,
+            model=BatDetect2(),
+            message_store=message_store,
+            tmp_audio=tmp_audio,
+            processing_filters=[SkipRecording(skipped)],  # type: ignore
+            min_age=min_age,
+        )
+
+    create_task(min_age=60)()
+
+    # The broken recording fails without stopping the backlog, and recent
+    # recordings are left to their own detection task.
+    outputs = {
+        stored.id: model_outputs
+        for stored, model_outputs in store.get_recordings(
+            ids=[item.id for item in recordings]
+        )
+    }
+    assert len(outputs[bats.id]) == 1
+    assert len(outputs[notbats.id]) == 1
+    assert outputs[broken.id] == []
+    assert outputs[skipped.id] == []
+    assert outputs[recent.id] == []
+
+    # Processed recordings are not run again.
+    create_task(min_age=0)()
+    outputs = {
+        stored.id: model_outputs
+        for stored, model_outputs in store.get_recordings(
+            ids=[item.id for item in recordings]
+        )
+    }
+    assert len(outputs[bats.id]) == 1
+    assert len(outputs[recent.id]) == 1
+
+
+def test_unprocessed_recording_filter(
+    tmp_path: Path,
+    recording: data.Recording,
+):
+    store = SqliteStore(tmp_path / "metadata.db")
+    store.store_recording(recording)
+    filter = UnprocessedRecordingFilter(store)
+
+    assert filter.should_process_recording(recording)
+
+    store.store_model_output(
+        data.ModelOutput(name_model="BatDetect2", recording=recording)
+    )
+    assert not filter.should_process_recording(recording)
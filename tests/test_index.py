@@ -0,0 +1,167 @@
+import datetime
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, Dict
+from uuid import UUID
+
+from acoupi import data
+from acoupi.components import SqliteStore
+
+from acoupi_batdetect2.index import DetectionIndex
+from acoupi_batdetect2.maintenance import MetadataStoreMaintainer
+
+StoreModelOutput = Callable[..., data.ModelOutput]
+
+NIGHT = datetime.datetime(2026, 7, 1, 22, 0, 0)
+
+
+def detection_ids(model_output: data.ModelOutput) -> Dict[str, UUID]:
+    return {
+        detection.tags[0].tag.value: detection.id
+        for detection in model_output.detections
+    }
+
+
+def test_detection_index_range_queries(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    db_path = tmp_path / "metadata.db"
+    store = SqliteStore(db_path)
+    index = DetectionIndex(db_path)
+
+    # Detections stored before the index is created.
+    first = store_model_output(
+        store,
+        NIGHT,
+        [
+            (0.1, 40000, 0.11, 70000, "Myotis mystacinus"),
+            (1.0, 25000, 1.01, 35000, "Nyctalus noctula"),
+        ],
+    )
+    index.create()
+
+    # Detections stored afterwards are indexed by the triggers.
+    second = store_model_output(
+        store,
+        NIGHT + datetime.timedelta(days=3),
+        [(2.0, 45000, 2.01, 55000, "Pipistrellus pygmaeus")],
+    )
+
+    # Only the detections stored afterwards are indexed until the stored
+    # detections are, once.
+    assert len(index.query()) == 1
+    index.index_stored()
+    index.create()
+    index.index_stored()
+    assert len(index.query()) == 3
+
+    # Frequency band.
+    band = index.query(low_freq=40000, high_freq=60000)
+    assert [detection.species for detection in band] == [
+        "Myotis mystacinus",
+        "Pipistrellus pygmaeus",
+    ]
+    assert band[0].detection_id == detection_ids(first)["Myotis mystacinus"]
+    assert band[0].recording_id == first.recording.id
+    assert band[1].detection_id == second.detections[0].id
+
+    # Time window overlapping a single call.
+    calls = index.query(
+        start=NIGHT + datetime.timedelta(seconds=0.105),
+        end=NIGHT + datetime.timedelta(seconds=0.5),
+    )
+    assert [detection.species for detection in calls] == ["Myotis mystacinus"]
+    assert calls[0].start_time == NIGHT + datetime.timedelta(seconds=0.1)
+
+    # Species and time range.
+    assert (
+        index.query(
+            start=NIGHT + datetime.timedelta(days=1),
+            species="Myotis mystacinus",
+        )
+        == []
+    )
+    assert (
+        len(index.query(species=["Nyctalus noctula", "Pipistrellus pygmaeus"]))
+        == 2
+    )
+    assert index.query(species="Unknown") == []
+    assert index.query(min_score=0.95) == []
+    assert len(index.query(limit=1)) == 1
+
+
+def test_detection_index_follows_pruning(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    db_path = tmp_path / "metadata.db"
+    store = SqliteStore(db_path)
+    index = DetectionIndex(db_path)
+    index.create()
+
+    store_model_output(
+        store,
+        NIGHT,
+        [(0.1, 40000, 0.11, 70000, "Myotis mystacinus")],
+    )
+    kept = store_model_output(
+        store,
+        NIGHT + datetime.timedelta(days=40),
+        [(0.1, 40000, 0.11, 70000, "Myotis mystacinus")],
+    )
+
+    MetadataStoreMaintainer(db_path).prune(NIGHT + datetime.timedelta(days=30))
+
+    assert [detection.detection_id for detection in index.query()] == [
+        kept.detections[0].id
+    ]
+
+
+def test_detection_index_resolves_seconds(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    """Test the R*Tree narrows time ranges of a few seconds."""
+    db_path = tmp_path / "metadata.db"
+    store = SqliteStore(db_path)
+    index = DetectionIndex(db_path)
+    index.create()
+
+    created_on = datetime.datetime.now().replace(microsecond=0)
+    model_output = store_model_output(
+        store,
+        created_on,
+        [(1.5, 40000, 1.51, 70000, "Myotis mystacinus")],
+    )
+
+    with sqlite3.connect(db_path) as connection:
+        (min_time, max_time, start_time, end_time), *_ = connection.execute(
+            "SELECT min_time, max_time, "
+            "start_time - origin.seconds, end_time - origin.seconds "
+            "FROM detection_index, detection_index_origin AS origin"
+        ).fetchall()
+    assert start_time - 1 < min_time <= start_time
+    assert end_time <= max_time < end_time + 1
+
+    (detection,) = index.query(
+        start=created_on + datetime.timedelta(seconds=1),
+        end=created_on + datetime.timedelta(seconds=2),
+    )
+    assert detection.detection_id == model_output.detections[0].id
+
+
+def test_detection_index_create_skips_the_write_lock(tmp_path: Path):
+    """Test creating an existing index does not wait for other writers."""
+    db_path = tmp_path / "metadata.db"
+    SqliteStore(db_path)
+    index = DetectionIndex(db_path)
+    index.create()
+
+    with sqlite3.connect(db_path, isolation_level=None) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        start = time.monotonic()
+        index.create()
+        assert time.monotonic() - start < 1
+        connection.execute("ROLLBACK")
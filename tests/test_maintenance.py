@@ -0,0 +1,160 @@
+import datetime
+import sqlite3
+from pathlib import Path
+from typing import Callable
+
+from acoupi import data
+from acoupi.components import SqliteMessageStore, SqliteStore, types
+
+from acoupi_batdetect2.maintenance import (
+    MessageStoreMaintainer,
+    MetadataStoreMaintainer,
+    generate_maintenance_task,
+)
+
+StoreModelOutput = Callable[..., data.ModelOutput]
+
+NOW = datetime.datetime.now()
+OLD = NOW - datetime.timedelta(days=40)
+CUTOFF = NOW - datetime.timedelta(days=30)
+
+
+def count(path: Path, table: str) -> int:
+    with sqlite3.connect(path) as connection:
+        (rows,) = connection.execute(
+            f"SELECT COUNT(*) FROM {table}"
+        ).fetchone()
+    return rows
+
+
+def test_metadata_maintainer_prunes_and_archives(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    db_path = tmp_path / "metadata.db"
+    archive_path = tmp_path / "archive.db"
+    store = SqliteStore(db_path)
+    store.store_deployment(data.Deployment(name="test"))
+
+    old = store_model_output(store, OLD)
+    new = store_model_output(store, NOW)
+
+    maintainer = MetadataStoreMaintainer(db_path, archive_path=archive_path)
+    maintainer.create_indexes()
+    assert maintainer.prune(CUTOFF) == 1
+
+    assert store.get_recordings(ids=[old.recording.id]) == []
+    assert len(store.get_recordings(ids=[new.recording.id])) == 1
+    assert count(db_path, "detection") == 1
+    assert count(db_path, "predicted_tag") == 1
+
+    archive = SqliteStore(archive_path)
+    ((recording, model_outputs),) = archive.get_recordings(
+        ids=[old.recording.id]
+    )
+    assert recording.id == old.recording.id
+    assert model_outputs[0].detections == old.detections
+
+    # Compaction only switches the store to incremental vacuum on request.
+    maintainer.compact(pages=100)
+    with sqlite3.connect(db_path) as connection:
+        (mode,) = connection.execute("PRAGMA auto_vacuum").fetchone()
+    assert mode == 0
+
+    maintainer.compact(pages=100, convert_auto_vacuum=True)
+    maintainer.analyze()
+    with sqlite3.connect(db_path) as connection:
+        (mode,) = connection.execute("PRAGMA auto_vacuum").fetchone()
+        indexes = {
+            name
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+    assert mode == 2
+    assert "idx_model_output__created_on" in indexes
+
+
+def test_message_maintainer_keeps_unsent_messages(tmp_path: Path):
+    db_path = tmp_path / "messages.db"
+    message_store = SqliteMessageStore(db_path)
+
+    sent = data.Message(content="sent", created_on=OLD)
+    unsent = data.Message(content="unsent", created_on=OLD)
+    recent = data.Message(content="recent", created_on=NOW)
+    for message in [sent, unsent, recent]:
+        message_store.store_message(message)
+    for message in [sent, recent]:
+        message_store.store_response(
+            data.Response(status=data.ResponseStatus.SUCCESS, message=message)
+        )
+
+    assert MessageStoreMaintainer(db_path).prune(CUTOFF) == 1
+
+    assert message_store.get_unsent_messages() == [unsent]
+    assert count(db_path, "message") == 2
+    assert count(db_path, "response") == 1
+
+
+class Condition(types.RecordingCondition):
+    def __init__(self, holds: bool = True):
+        self.holds = holds
+
+    def should_record(self) -> bool:
+        return self.holds
+
+
+def test_maintenance_task_is_skipped_while_recording(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    db_path = tmp_path / "metadata.db"
+    store = SqliteStore(db_path)
+    store.store_deployment(data.Deployment(name="test"))
+    store_model_output(store, OLD)
+
+    maintainers = [MetadataStoreMaintainer(db_path)]
+    retention = datetime.timedelta(days=30)
+
+    generate_maintenance_task(
+        maintainers,
+        recording_conditions=[Condition()],
+        retention=retention,
+    )()
+    assert count(db_path, "recording") == 1
+
+    generate_maintenance_task(
+        maintainers,
+        recording_conditions=[],
+        retention=retention,
+    )()
+    assert count(db_path, "recording") == 0
+
+
+def test_maintenance_task_runs_unless_all_conditions_hold(
+    tmp_path: Path,
+    store_model_output: StoreModelOutput,
+):
+    """Test the maintenance runs whenever the program does not record."""
+    db_path = tmp_path / "metadata.db"
+    store = SqliteStore(db_path)
+    store.store_deployment(data.Deployment(name="test"))
+    store_model_output(store, OLD)
+
+    maintainers = [MetadataStoreMaintainer(db_path)]
+    retention = datetime.timedelta(days=30)
+
+    generate_maintenance_task(
+        maintainers,
+        recording_conditions=[Condition(), Condition()],
+        retention=retention,
+    )()
+    assert count(db_path, "recording") == 1
+
+    # The recording task does not record unless all conditions hold.
+    generate_maintenance_task(
+        maintainers,
+        recording_conditions=[Condition(), Condition(holds=False)],
+        retention=retention,
+    )()
+    assert count(db_path, "recording") == 0
@@ -0,0 +1,204 @@
+import os
+import time
+from pathlib import Path
+
+from acoupi import data
+from acoupi.components import SqliteMessageStore
+
+from acoupi_batdetect2.metrics import (
+    MetricsStore,
+    WorkerMemory,
+    generate_metrics_task,
+    read_memory_usage,
+    render_metrics,
+)
+from acoupi_batdetect2.program import BatDetect2_Program
+
+
+def test_metrics_store_accumulates_task_metrics(tmp_path: Path):
+    """Test task runs are counted and their durations bucketed."""
+    store = MetricsStore(
+        tmp_path / "metrics.db", buckets=[1, 10, float("inf")]
+    )
+
+    store.record_published("detection_task")
+    store.record_published("detection_task")
+    store.record_started("detection_task")
+    store.record_finished("detection_task", 0.5)
+    store.record_started("detection_task")
+    store.record_finished("detection_task", 20, failed=True)
+
+    (metrics,) = store.get_task_metrics()
+    assert metrics.task == "detection_task"
+    assert metrics.published == 2
+    assert metrics.started == 2
+    assert metrics.finished == 2
+    assert metrics.failures == 1
+    assert metrics.queued == 0
+    assert metrics.duration_sum == 20.5
+    assert metrics.buckets == [1, 0, 1]
+
+
+def test_render_metrics_in_prometheus_format(tmp_path: Path):
+    """Test metrics are rendered in the Prometheus text format."""
+    store = MetricsStore(tmp_path / "metrics.db", buckets=[1, float("inf")])
+    store.record_published("recording_task")
+    store.record_started("recording_task")
+    store.record_finished("recording_task", 0.25)
+    store.record_published("recording_task")
+
+    text = render_metrics(
+        store.get_task_metrics(),
+        {"unsent_messages": ("Messages waiting to be sent.", 3)},
+        buckets=store.buckets,
+    )
+
+    lines = text.splitlines()
+    assert "# TYPE acoupi_batdetect2_task_runs_total counter" in lines
+    assert (
+        'acoupi_batdetect2_task_runs_total{task="recording_task"} 1' in lines
+    )
+    assert 'acoupi_batdetect2_task_queued{task="recording_task"} 1' in lines
+    assert (
+        "acoupi_batdetect2_task_duration_seconds_bucket"
+        '{task="recording_task",le="1"} 1'
+    ) in lines
+    assert (
+        "acoupi_batdetect2_task_duration_seconds_bucket"
+        '{task="recording_task",le="+Inf"} 1'
+    ) in lines
+    assert (
+        'acoupi_batdetect2_task_duration_seconds_sum{task="recording_task"} '
+        "0.25"
+    ) in lines
+    assert "acoupi_batdetect2_unsent_messages 3" in lines
+
+
+def test_metrics_store_keeps_last_memory_of_each_worker(tmp_path: Path):
+    """Test the memory usage of each worker process is reported."""
+    store = MetricsStore(tmp_path / "metrics.db")
+
+    store.record_memory(
+        WorkerMemory(worker="detection@pi", pid=10, rss=5, pss=4, shared=2)
+    )
+    store.record_finished(
+        "detection_task",
+        1.0,
+        memory=WorkerMemory(
+            worker="detection@pi", pid=10, rss=8, pss=6, shared=3
+        ),
+    )
+    store.record_memory(
+        WorkerMemory(worker="detection@pi", pid=11, rss=7, pss=5, shared=3)
+    )
+    store.remove_worker_memory([11])
+
+    (memory,) = store.get_worker_memory()
+    assert memory.worker == "detection@pi"
+    assert memory.pid == 10
+    assert memory.rss == 8
+
+    lines = render_metrics([], {}, worker_memory=[memory]).splitlines()
+    assert "# TYPE acoupi_batdetect2_worker_memory_bytes gauge" in lines
+    assert (
+        "acoupi_batdetect2_worker_memory_bytes"
+        '{worker="detection@pi",pid="10",type="pss"} 6'
+    ) in lines
+
+
+def test_read_memory_usage():
+    """Test the memory usage of the current process is read."""
+    memory = read_memory_usage()
+    assert memory.rss > 0
+    assert 0 < memory.pss <= memory.rss
+    assert memory.shared <= memory.rss
+
+
+def test_program_writes_metrics_textfile(
+    recording: data.Recording,
+    program: BatDetect2_Program,
+):
+    """Test the program records task runs and writes the metrics file."""
+    assert "metrics_task" in program.tasks
+    assert program.app.conf.task_routes["metrics_task"] == {
+        "queue": "management"
+    }
+
+    program.tasks["detection_task"].delay(recording).get()
+
+    # The run is recorded right after its result is stored.
+    for _ in range(50):
+        metrics = {m.task: m for m in program.metrics_store.get_task_metrics()}
+        if "detection_task" in metrics and metrics["detection_task"].finished:
+            break
+        time.sleep(0.1)
+
+    program.tasks["metrics_task"].delay().get()
+
+    textfile = program.config.metrics.textfile
+    lines = textfile.read_text().splitlines()
+    assert (
+        'acoupi_batdetect2_task_runs_total{task="detection_task"} 1' in lines
+    )
+    assert "acoupi_batdetect2_pending_temp_files 0" in lines
+    assert any(
+        line.startswith("acoupi_batdetect2_unsent_messages ") for line in lines
+    )
+    assert any(
+        line.startswith("acoupi_batdetect2_store_size_bytes ")
+        for line in lines
+    )
+    assert any(
+        line.startswith("acoupi_batdetect2_worker_memory_bytes{")
+        for line in lines
+    )
+
+
+def test_metrics_task_counts_unsent_messages(tmp_path: Path):
+    """Test the unsent messages are counted in the message store."""
+    messages_db = tmp_path / "messages.db"
+    message_store = SqliteMessageStore(messages_db)
+    sent, failed, unsent = [
+        data.Message(content=content) for content in ["a", "b", "c"]
+    ]
+    for message in [sent, failed, unsent]:
+        message_store.store_message(message)
+    message_store.store_response(
+        data.Response(message=sent, status=data.ResponseStatus.SUCCESS)
+    )
+    message_store.store_response(
+        data.Response(message=failed, status=data.ResponseStatus.FAILED)
+    )
+
+    textfile = tmp_path / "metrics.prom"
+    metrics_task = generate_metrics_task(
+        metrics_store=MetricsStore(tmp_path / "metrics.db"),
+        textfile=textfile,
+        tmp_audio=tmp_path,
+        db_metadata=tmp_path / "metadata.db",
+        messages_db=messages_db,
+    )
+    metrics_task()
+
+    lines = textfile.read_text().splitlines()
+    assert "acoupi_batdetect2_unsent_messages 2" in lines
+
+
+def test_metrics_store_reopens_connection_after_fork(tmp_path: Path):
+    """Test each process writes through its own connection."""
+    store = MetricsStore(tmp_path / "metrics.db")
+    store.record_started("detection_task")
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            store.record_started("detection_task")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    store.reopen()
+    store.record_started("detection_task")
+
+    (metrics,) = store.get_task_metrics()
+    assert metrics.started == 3
@@ -1,5 +1,11 @@
 """Test Suite for Acoupi BatDetect2 Model."""
 
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pytest
+import soundfile
 from acoupi import data
 
 from acoupi_batdetect2.model import BatDetect2
@@ -12,3 +18,212 @@ def test_batdetect2(recording: data.Recording):
     assert isinstance(detections, data.ModelOutput)
     assert detections.name_model == "BatDetect2"
     assert len(detections.detections) == 51
+
+
+def test_batdetect2_cascade(recording: data.Recording):
+    model = BatDetect2(cascade=True)
+    detections = model.run(recording)
+
+    assert isinstance(detections, data.ModelOutput)
+    assert detections.name_model == "BatDetect2"
+    assert len(detections.detections) > 0
+
+    for detection in detections.detections:
+        assert detection.location is not None
+        start_time, _, _, _ = detection.location.coordinates
+        assert 0 <= start_time <= recording.duration
+
+
+def test_batdetect2_cascade_windows_match_full_run(
+    pippip_recording: data.Recording,
+):
+    model = BatDetect2(
+        cascade=True,
+        activity_threshold=4.0,
+        context=0.1,
+        max_active_fraction=1.0,
+    )
+
+    # The second window starts well into the recording, so its detections
+    # must be shifted back to recording time.
+    spec = model.prepare(pippip_recording)
+    windows = model._find_active_windows(spec)
+    assert len(windows) > 1
+    assert sum(end - start for start, end in windows) < spec.shape[-1]
+    assert windows[1][0] * model._column_duration() > 0.2
+
+    def above_threshold(model_output, threshold=0.4):
+        return sorted(
+            (
+                detection.location.coordinates,  # type: ignore
+                detection.tags[0].tag.value,
+                detection.detection_score,
+            )
+            for detection in model_output.detections
+            if detection.detection_score >= threshold
+        )
+
+    expected = above_threshold(BatDetect2().run(pippip_recording))
+    detections = above_threshold(model.run(pippip_recording))
+
+    # The network attends over the whole input, so cropping shifts the
+    # scores slightly, the peaks by up to one column and the regressed
+    # call durations by a little more.
+    column = model._column_duration()
+    assert len(detections) == len(expected) > 0
+    for (box, species, score), (
+        expected_box,
+        expected_species,
+        expected_score,
+    ) in zip(detections, expected):
+        assert species == expected_species
+        assert abs(box[0] - expected_box[0]) <= column + 1e-6
+        assert abs(box[2] - expected_box[2]) <= 2 * column + 1e-6
+        assert abs(score - expected_score) < 0.05
+
+
+def test_batdetect2_cascade_runs_on_sparse_activity(
+    notbat_recording: data.Recording,
+):
+    model = BatDetect2(cascade=True)
+
+    spec = model.prepare(notbat_recording)
+    windows = model._find_active_windows(spec)
+    active = sum(end - start for start, end in windows)
+    assert 0 < active < model.max_active_fraction * spec.shape[-1]
+
+    expected = BatDetect2().run(notbat_recording)
+    detections = model.run(notbat_recording)
+    assert [
+        d.location for d in detections.detections if d.detection_score >= 0.4
+    ] == [d.location for d in expected.detections if d.detection_score >= 0.4]
+
+
+def test_batdetect2_cascade_skips_silent_recording(
+    notbat_recording: data.Recording,
+):
+    model = BatDetect2(cascade=True, activity_threshold=100)
+    detections = model.run(notbat_recording)
+
+    assert detections.detections == []
+
+
+def _summary(detections, key="species"):
+    return sorted(
+        (
+            detection.location.coordinates,  # type: ignore
+            [tag.tag for tag in detection.tags if tag.tag.key == key],
+        )
+        for detection in detections
+    )
+
+
+def _channels(detection: data.Detection):
+    return {
+        tag.tag.value for tag in detection.tags if tag.tag.key == "channel"
+    }
+
+
+@pytest.mark.parametrize("channel_batch_size", [None, 1])
+def test_batdetect2_multichannel(
+    tmp_path: Path,
+    recording: data.Recording,
+    channel_batch_size: Optional[int],
+):
+    bats, samplerate = soundfile.read(recording.path)
+    channels = [bats[::-1], bats]
+
+    # Write each channel as a mono file and both as a stereo file.
+    mono_recordings = []
+    for channel, audio in enumerate(channels):
+        path = tmp_path / f"channel_{channel}.wav"
+        soundfile.write(path, audio, samplerate)
+        mono_recordings.append(recording.model_copy(update={"path": path}))
+
+    path = tmp_path / "stereo.wav"
+    soundfile.write(path, np.stack(channels, axis=1), samplerate)
+    stereo = recording.model_copy(update={"path": path, "audio_channels": 2})
+
+    model = BatDetect2(channel_batch_size=channel_batch_size)
+    stereo_detections = model.run(stereo).detections
+
+    # Every detection comes from the mono file of one of its channels.
+    mono_summaries = [
+        _summary(model.run(mono).detections) for mono in mono_recordings
+    ]
+    assert {"0", "1"} <= set.union(*map(_channels, stereo_detections))
+    for detection in stereo_detections:
+        assert _channels(detection)
+        assert any(
+            _summary([detection])[0] in mono_summaries[int(channel)]
+            for channel in _channels(detection)
+        )
+
+
+@pytest.mark.parametrize("channel_batch_size", [None, 1])
+def test_batdetect2_multichannel_counts_each_call_once(
+    tmp_path: Path,
+    recording: data.Recording,
+    channel_batch_size: Optional[int],
+):
+    bats, samplerate = soundfile.read(recording.path)
+    path = tmp_path / "stereo.wav"
+    soundfile.write(path, np.stack([bats, bats], axis=1), samplerate)
+    stereo = recording.model_copy(update={"path": path, "audio_channels": 2})
+
+    model = BatDetect2(channel_batch_size=channel_batch_size)
+    mono_detections = model.run(recording).detections
+    stereo_detections = model.run(stereo).detections
+
+    # The calls heard on both channels are merged and keep both channels.
+    assert _summary(stereo_detections) == _summary(mono_detections)
+    assert all(
+        _channels(detection) == {"0", "1"} for detection in stereo_detections
+    )
+
+    # Mono detections are not tagged with a channel.
+    assert all(not _channels(detection) for detection in mono_detections)
+
+
+@pytest.mark.parametrize("fast_spectrogram", [False, True])
+def test_batdetect2_pipelined(
+    recording: data.Recording,
+    notbat_recording: data.Recording,
+    fast_spectrogram: bool,
+):
+    model = BatDetect2(fast_spectrogram=fast_spectrogram)
+    recordings = [recording, notbat_recording, recording]
+
+    outputs = list(model.run_pipelined(recordings, prefetch=1))
+
+    # Outputs are in order and match the sequential runs.
+    assert [output.recording for output in outputs] == recordings
+
+    # The order of the detections of a recording is not deterministic.
+    def summary(detections):
+        return sorted(
+            (
+                detection.location.coordinates,
+                detection.detection_score,
+                detection.tags[0].tag.value,
+            )
+            for detection in detections
+        )
+
+    for output, recording in zip(outputs, recordings):
+        expected = model.run(recording).detections
+        assert summary(output.detections) == summary(expected)
+
+
+def test_batdetect2_pipelined_raises_in_order(
+    tmp_path: Path,
+    recording: data.Recording,
+):
+    missing = recording.model_copy(update={"path": tmp_path / "missing.wav"})
+    model = BatDetect2()
+
+    outputs = model.run_pipelined([recording, missing, recording])
+
+    assert next(outputs).recording == recording
+    with pytest.raises(soundfile.LibsndfileError):
+        next(outputs)
@@ -1,9 +1,18 @@
+import datetime
+import json
+import shutil
+import sqlite3
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+import soundfile
 from acoupi import components, data
 
 from acoupi_batdetect2.configuration import (
     BatDetect2_ConfigSchema,
 )
-from acoupi_batdetect2.program import BatDetect2_Program
+from acoupi_batdetect2.program import BatDetect2_Program, get_worker_config
 
 
 def test_can_run_detection_program(
@@ -44,3 +53,155 @@ def test_can_run_detection_program(
     # Check that messages were stored in the database.
     messages = program.message_store.get_unsent_messages()
     assert len(messages) > 0
+
+
+def test_tasks_are_routed_to_dedicated_queues(
+    program: BatDetect2_Program,
+):
+    """Test recording, detection and management run on separate queues."""
+    routes = program.app.conf.task_routes
+
+    assert routes["recording_task"] == {"queue": "recording"}
+    assert routes["detection_task"] == {"queue": "detection"}
+    assert routes["file_management_task"] == {"queue": "management"}
+    assert routes["summary_task"] == {"queue": "summary"}
+    assert routes["maintenance_task"] == {"queue": "management"}
+
+
+def test_worker_concurrency_is_configurable(monkeypatch):
+    monkeypatch.setenv("ACOUPI_BATDETECT2_DETECTION_CONCURRENCY", "2")
+
+    workers = {worker.name: worker for worker in get_worker_config().workers}
+
+    assert workers["recording"].queues == ["recording"]
+    assert workers["recording"].concurrency == 1
+    assert workers["detection"].queues == ["detection"]
+    assert workers["detection"].concurrency == 2
+    assert workers["compression"].queues == ["compression"]
+    assert workers["compression"].concurrency == 1
+
+
+def test_detections_are_indexed(
+    recording: data.Recording,
+    program: BatDetect2_Program,
+    program_config: BatDetect2_ConfigSchema,
+):
+    store = components.SqliteStore(program_config.paths.db_metadata)
+    store.store_recording(recording)
+
+    program.tasks["detection_task"].delay(recording).get()
+
+    detections = program.detection_index.query(
+        start=recording.created_on,
+        low_freq=40000,
+        high_freq=60000,
+    )
+    assert len(detections) > 0
+    assert all(
+        detection.recording_id == recording.id for detection in detections
+    )
+
+
+def test_multichannel_detections_are_summarised_by_species(
+    tmp_path: Path,
+    recording: data.Recording,
+    program: BatDetect2_Program,
+    program_config: BatDetect2_ConfigSchema,
+):
+    """Test each call of a stereo recording is counted once, by species."""
+    bats, samplerate = soundfile.read(recording.path)
+    path = tmp_path / "stereo.wav"
+    soundfile.write(path, np.stack([bats, bats], axis=1), samplerate)
+    stereo = recording.model_copy(
+        update={
+            "id": uuid4(),
+            "path": path,
+            "audio_channels": 2,
+            "created_on": recording.created_on + datetime.timedelta(seconds=1),
+        }
+    )
+
+    store = components.SqliteStore(program_config.paths.db_metadata)
+    (summariser,) = program.get_summarisers(program_config)
+
+    def count_species():
+        summary = json.loads(
+            summariser.build_summary(datetime.datetime.now()).content
+        )
+        return {
+            species: stats["count"]
+            for species, stats in summary.items()
+            if species != "timeinterval"
+        }
+
+    store.store_recording(recording)
+    program.tasks["detection_task"].delay(recording).get()
+    mono_counts = count_species()
+    assert mono_counts
+    assert set(mono_counts) <= set(program.model.api.CONFIG["class_names"])
+
+    # The stereo recording adds the same counts as the mono recording.
+    store.store_recording(stereo)
+    program.tasks["detection_task"].delay(stereo).get()
+    assert count_species() == {
+        species: 2 * count for species, count in mono_counts.items()
+    }
+
+    mono_message, stereo_message = [
+        data.ModelOutput.model_validate_json(message.content)
+        for message in program.message_store.get_unsent_messages()
+    ]
+    assert len(stereo_message.detections) == len(mono_message.detections)
+    for detection in stereo_message.detections:
+        assert {tag.tag.key for tag in detection.tags} == {
+            "species",
+            "channel",
+        }
+        assert {
+            tag.tag.value for tag in detection.tags if tag.tag.key == "channel"
+        } == {"0", "1"}
+
+
+def test_on_end_runs_the_final_detection_task(
+    recording: data.Recording,
+    program: BatDetect2_Program,
+    program_config: BatDetect2_ConfigSchema,
+):
+    """Test the recordings left when the program ends are processed."""
+    for task in ["detection_backlog_task", "final_detection_task"]:
+        assert program.app.conf.task_routes[task] == {"queue": "detection"}
+
+    path = program_config.paths.tmp_audio / "remaining.wav"
+    shutil.copy(recording.path, path)
+    remaining = recording.model_copy(update={"path": path})
+
+    store = components.SqliteStore(program_config.paths.db_metadata)
+    store.store_recording(remaining)
+
+    program.on_end(remaining.deployment)
+
+    ((_, model_outputs),) = store.get_recordings(ids=[remaining.id])
+    assert len(model_outputs) == 1
+
+    # The run goes through the task, so that its metrics are recorded.
+    metrics = {m.task: m for m in program.metrics_store.get_task_metrics()}
+    assert metrics["final_detection_task"].finished == 1
+
+
+def test_on_start_indexes_the_stored_detections(
+    recording: data.Recording,
+    program: BatDetect2_Program,
+    program_config: BatDetect2_ConfigSchema,
+):
+    """Test the detections stored before the index are indexed on start."""
+    program.tasks["detection_task"].delay(recording).get()
+
+    # Drop the entries, as if the detections were stored before the index.
+    db_path = program_config.paths.db_metadata
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("DELETE FROM detection_index")
+    assert program.detection_index.query() == []
+
+    program.on_start(recording.deployment)
+
+    assert len(program.detection_index.query()) > 0
@@ -0,0 +1,87 @@
+"""Test Suite for the polyphase resampler."""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+import soundfile as sf
+from batdetect2 import api
+
+from tests.benchmarks.ingest import run_ingest_benchmark
+
+from acoupi_batdetect2.model import BatDetect2
+from acoupi_batdetect2.resampling import PolyphaseResampler, design_filter
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "audiofile_test1_myomys.wav",
+        "audiofile_test2_pippip.wav",
+        "audiofile_test3_nobats.wav",
+    ],
+)
+def test_load_audio_matches_library(filename: str):
+    expected = api.load_audio(str(DATA_DIR / filename))
+
+    audio = BatDetect2().load_audio(str(DATA_DIR / filename))
+
+    assert audio.shape == (1, expected.shape[0])
+    assert audio.dtype == expected.dtype
+    np.testing.assert_array_equal(audio[0], expected)
+
+
+@pytest.mark.parametrize("samplerate", [96_000, 250_000, 384_000])
+def test_resampler_keeps_channels_in_sync(samplerate: int):
+    rng = np.random.default_rng(0)
+    mono = rng.standard_normal(samplerate // 10).astype(np.float32)
+    resampler = PolyphaseResampler()
+
+    stereo = resampler(np.stack([mono, mono]), samplerate, 256_000)
+
+    assert stereo.shape == (2, 25_600)
+    assert stereo.dtype == np.float32
+    np.testing.assert_array_equal(stereo[0], stereo[1])
+    np.testing.assert_array_equal(
+        stereo[0],
+        resampler(mono, samplerate, 256_000),
+    )
+
+
+def test_resampler_designs_filter_once_per_rate_pair():
+    design_filter.cache_clear()
+    audio = np.zeros(1000, dtype=np.float32)
+
+    PolyphaseResampler()(audio, 192_000, 256_000)
+    PolyphaseResampler()(audio, 192_000, 256_000)
+
+    info = design_filter.cache_info()
+    assert (info.misses, info.hits) == (1, 1)
+    assert design_filter(192_000, 256_000)[:2] == (4, 3)
+
+
+def test_native_rate_audio_is_not_resampled(tmp_path: Path):
+    path = tmp_path / "native.wav"
+    samples = np.linspace(-0.5, 0.5, 25_600, dtype=np.float32)
+    sf.write(path, samples, 256_000, subtype="FLOAT")
+    model = BatDetect2()
+    design_filter.cache_clear()
+
+    audio = model.load_audio(str(path))
+
+    np.testing.assert_array_equal(audio[0], samples)
+    assert design_filter.cache_info().misses == 0
+
+
+def test_ingest_benchmark_runs(tmp_path: Path):
+    results = run_ingest_benchmark(
+        tmp_path,
+        samplerates=[192_000, 256_000],
+        duration=0.1,
+        repeats=1,
+    )
+
+    assert [result.samplerate for result in results] == [192_000, 256_000]
+    assert all(result.fast_ms > 0 for result in results)
@@ -0,0 +1,54 @@
+import gc
+from types import SimpleNamespace
+
+import pytest
+from acoupi import data
+
+from acoupi_batdetect2.model import BatDetect2
+from acoupi_batdetect2.sharing import ModelPreloader, share_model_weights
+
+
+@pytest.fixture(autouse=True)
+def unfreeze_gc():
+    yield
+    gc.unfreeze()
+
+
+def worker(*queues: str) -> SimpleNamespace:
+    """Create a Celery worker consuming from the given queues."""
+    consume_from = {queue: object() for queue in queues}
+    amqp = SimpleNamespace(queues=SimpleNamespace(consume_from=consume_from))
+    return SimpleNamespace(app=SimpleNamespace(amqp=amqp))
+
+
+def test_share_model_weights(recording: data.Recording):
+    """Test the model weights are moved to read-only shared memory."""
+    model = BatDetect2()
+    expected = model.run(recording)
+
+    size = share_model_weights(model)
+
+    network = model.api.MODEL
+    parameters = list(network.parameters())
+    assert size >= sum(p.numel() * p.element_size() for p in parameters)
+    assert all(p.is_shared() for p in parameters)
+    assert all(b.is_shared() for b in network.buffers())
+    assert not any(p.requires_grad for p in parameters)
+    assert not network.training
+    assert gc.get_freeze_count() > 0
+
+    output = model.run(recording)
+    assert len(output.detections) == len(expected.detections)
+
+
+def test_preloader_only_loads_model_in_detection_worker():
+    """Test the model is only loaded by workers of the given queues."""
+    model = BatDetect2()
+    preloader = ModelPreloader(model, ["detection"])
+
+    preloader.on_worker_init(sender=worker("recording", "celery"))
+    assert model._api is None
+
+    preloader.on_worker_init(sender=worker("detection"))
+    assert model._api is not None
+    assert all(p.is_shared() for p in model.api.MODEL.parameters())
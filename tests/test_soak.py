@@ -0,0 +1,39 @@
+from pathlib import Path
+
+from tests.soak import SoakConfig, run_soak
+
+
+def test_soak_harness_runs_full_pipeline(tmp_path: Path):
+    """Test a short soak run exercises every task of the program."""
+    config = SoakConfig(
+        duration=6,
+        recording_interval=1,
+        clip_duration=1,
+        call_probability=1,
+        management_interval=2,
+        messaging_interval=2,
+        summary_interval=3,
+        sample_interval=1,
+        drain_timeout=60,
+        seed=0,
+    )
+
+    report = run_soak(config, tmp_path)
+
+    assert report.recordings > 0
+    assert report.processed == report.recordings
+    assert report.throughput > 0
+    assert len(report.samples) > 0
+
+    for name in [
+        "recording_task",
+        "detection_task",
+        "file_management_task",
+        "send_messages_task",
+        "summary_task",
+    ]:
+        assert name in report.tasks
+        assert report.tasks[name].failures == 0
+
+    assert report.samples[-1].pending_files == 0
+    assert report.samples[-1].unsent_messages == 0
@@ -0,0 +1,52 @@
+"""Test Suite for the fast spectrogram pipeline."""
+
+from pathlib import Path
+
+import pytest
+import torch
+from acoupi import data
+from batdetect2 import api
+
+from acoupi_batdetect2.model import BatDetect2
+from acoupi_batdetect2.spectrogram import FastSpectrogram
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "audiofile_test1_myomys.wav",
+        "audiofile_test2_pippip.wav",
+        "audiofile_test3_nobats.wav",
+    ],
+)
+def test_fast_spectrogram_matches_library(filename: str):
+    audio = api.load_audio(str(DATA_DIR / filename))
+
+    expected = api.generate_spectrogram(audio)
+    spec = FastSpectrogram()(audio)
+
+    assert spec.shape == expected.shape
+    assert spec.dtype == torch.float32
+    torch.testing.assert_close(spec, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_fast_spectrogram_reuses_buffers(recording: data.Recording):
+    audio = api.load_audio(str(recording.path))
+    spectrogram = FastSpectrogram()
+
+    first = spectrogram(audio).clone()
+    second = spectrogram(audio)
+
+    assert spectrogram(audio) is second
+    assert len(spectrogram._plans) == 1
+    torch.testing.assert_close(first, second)
+
+
+def test_batdetect2_fast_spectrogram(recording: data.Recording):
+    model = BatDetect2(fast_spectrogram=True)
+    detections = model.run(recording)
+
+    assert isinstance(detections, data.ModelOutput)
+    assert len(detections.detections) == 51